@@ -14,20 +14,24 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 from time import time
 
 # Twisted imports
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
+from twisted.internet.defer import succeed
 
 # Local
-from ecagent.client import Client
+from ecagent.client import Client, PRIORITY_RESULT, PRIORITY_PARTIAL
 from ecagent.runner import CommandRunner
 from ecagent.message import IqMessage
+from ecagent.results import ResultStore, RESULT_STORE_TTL, RESULT_STORE_MAX_ENTRIES, RESULT_STORE_MAX_SIZE
+from ecagent.bytestream import IBBStream, IBB_THRESHOLD, IBB_BLOCK_SIZE
 
 import ecagent.twlogging as log
 from ecagent.verify import ECVerify
-from ecagent.functions import mem_clean
+from ecagent.functions import mem_clean, command_key
 
 from message import AGENT_VERSION_PROTOCOL
 
@@ -37,7 +41,21 @@ _E_UNVERIFIED_COMMAND = 251
 _CHECK_RAM_MAX_RSS_MB = 125
 _CHECK_RAM_INTERVAL = 60
 
-KEEPALIVED_TIMEOUT = 180
+_EXPIRE_INTERVAL = 30
+
+RESULTS_PATH = os.path.join(os.path.dirname(__file__), '..', 'cache', 'results')
+
+# Requests with the same key can't run at the same time: command name (default),
+# command name and some arguments (key = arg, ...) or any request (key = request).
+# parallel: running requests of a command (0 no limit)
+KEY_REQUEST = 'request'
+DEFAULT_CONCURRENCY = {
+    'service_control': {'key': ['service']},
+    'service_state': {'key': ['service']},
+    'script_run': {'key': KEY_REQUEST, 'parallel': 4},
+    'code_run': {'key': KEY_REQUEST, 'parallel': 4},
+    'agent_cancel': {'key': ['id']},
+}
 
 class SMAgent:
     def __init__(self, config):
@@ -77,29 +95,48 @@ class SMAgentXMPP(Client):
 
         log.info("Setting up Memory checker")
 
+        # key -> (expiry, command name, message id)
         self.running_commands = {}
         self.num_running_commands = 0
         self.timestamp = 0
 
+        self._running_by_command = {}
+        self._concurrency = dict(DEFAULT_CONCURRENCY)
+        self._concurrency.update(config['Plugins'].get('concurrency', {}))
+
+        # request key -> (command key, resent requests waiting for its result)
+        self._requests = {}
+        self.results = None
+        if 'result_store' not in config['Plugins'] or config['Plugins'].as_bool('result_store'):
+            self.results = self._result_store(config['Plugins'])
+
+        self.ibb_threshold = IBB_THRESHOLD
+        if 'ibb_threshold' in config['XMPP']:
+            self.ibb_threshold = config['XMPP'].as_int('ibb_threshold')
+
+        self.ibb_block_size = IBB_BLOCK_SIZE
+        if 'ibb_block_size' in config['XMPP']:
+            self.ibb_block_size = config['XMPP'].as_int('ibb_block_size')
+
+        self.expire_checker = LoopingCall(self._expire_running_commands)
+        self.expire_checker.start(_EXPIRE_INTERVAL, now=False)
+
         self.memory_checker = LoopingCall(self._check_memory, self.running_commands)
         self.memory_checker.start(_CHECK_RAM_INTERVAL)
-        
-        self.keepalive = LoopingCall(self._reconnect)
 
         log.debug("Loading XMPP...")
         Client.__init__(
             self,
             config['XMPP'],
             [("/iq[@type='set']", self.__onIq), ],
-            resource='ecm_agent-%d' % AGENT_VERSION_PROTOCOL)
+            resource='ecm_agent-%d' % AGENT_VERSION_PROTOCOL,
+            producer=self.command_runner.flow)
+
+        self.command_runner.xmpp_stats = self._xmpp_stats
+
+    def _xmpp_stats(self):
+        return {'ping': self.ping.stats(), 'dropped_partials': self.dropped_partials}
 
-    def _reconnect(self):
-        """ 
-        Disconnect the current reactor to try to connect again
-        """
-        log.info("No data received in %ss: Trying to reconnect" % KEEPALIVED_TIMEOUT)
-        reactor.disconnectAll()	
-            
     def __onIq(self, msg):
         """
         A new IQ message has been received and we should process it.
@@ -109,54 +146,168 @@ class SMAgentXMPP(Client):
         log.debug("q Message received: \n%s" % msg.toXml())
         log.debug("Message type: %s" % msg['type'])
 
-        if self.keepalive.running:
-            log.debug("Stop keepalived")
-            self.keepalive.stop()
-        
-        log.debug("Starting keepalived")
-        self.keepalive.start(KEEPALIVED_TIMEOUT, now=False)
-
         self.timestamp = time()
 
         message = IqMessage(msg)
         recv_command = message.command.replace('.', '_')
 
-        if recv_command in self.running_commands:
-            if self.timestamp > self.running_commands[recv_command]:
-                del self.running_commands[recv_command]
-                self.num_running_commands -= 1
-                log.debug("Deleted %s from running_commands dict as should have been completed" % (recv_command))
+        # Don't wait for the timer to free expired keys
+        self._expire_running_commands()
 
-        if recv_command not in self.running_commands:
+        if hasattr(message, 'command') and hasattr(message, 'from_'):
             log.debug('recieved new command: %s with message: %s' % (message.command, message))
+            log.debug('online contacts: %s' % self._online_contacts)
+            running_key = self._running_key(recv_command, message)
+            request_key = self._request_key(message)
+            message.command_key = command_key(recv_command, message.command_args)
+
+            if message.from_ not in self._online_contacts:
+                log.warn('IQ sender not in roster (%s), dropping message' % message.from_)
+
+            elif self._running_request(request_key, message) or self._stored_result(request_key, message):
+                # Resent request: no need to run it again
+                self._replay(request_key, message)
+
+            elif running_key in self.running_commands and self.command_runner.in_flight(message):
+                # Same read only command and arguments: it gets the running one's result
+                self._processCommand(message)
+
+            elif running_key in self.running_commands:
+                log.debug("already running given command %s" % running_key)
+                result = (_E_RUNNING_COMMAND, '', 'another command is running', 0)
+                self._send(result, message)
+
+            elif self._parallel(recv_command) and \
+                    self._running_by_command.get(recv_command, 0) >= self._parallel(recv_command):
+                log.debug("too many %s commands running" % recv_command)
+                result = (_E_RUNNING_COMMAND, '', 'too many %s commands running' % message.command, 0)
+                self._send(result, message)
+
+            else:
+                message.running_key = running_key
+                self._add_running(running_key, recv_command, message)
+                log.debug("Running commands: names: %s numbers: %i" % (self.running_commands, self.num_running_commands))
+                self._processCommand(message)
 
-            if hasattr(message, 'command') and hasattr(message, 'from_'):
-                log.debug('online contacts: %s' % self._online_contacts)
+        del msg
+        del message
 
-                if message.from_ not in self._online_contacts:
-                    log.warn('IQ sender not in roster (%s), dropping message' % message.from_)
-                else:
-                    self.running_commands[recv_command] = self.timestamp + int(message.command_args['timeout'])
-                    self.num_running_commands += 1
-                    log.debug("Running commands: names: %s numbers: %i" % (self.running_commands, self.num_running_commands))
-                    self._processCommand(message)
+    @staticmethod
+    def _result_store(config):
+        ttl = RESULT_STORE_TTL
+        if 'result_store_ttl' in config:
+            ttl = config.as_int('result_store_ttl')
 
-        else:
-            log.debug("already running given command %s" %recv_command)
-            result = (_E_RUNNING_COMMAND, '', 'another command is running', 0)
-            self._send(result, message)
+        max_entries = RESULT_STORE_MAX_ENTRIES
+        if 'result_store_max_entries' in config:
+            max_entries = config.as_int('result_store_max_entries')
 
-        del msg
-        del message
+        max_size = RESULT_STORE_MAX_SIZE
+        if 'result_store_max_size' in config:
+            max_size = config.as_int('result_store_max_size')
+
+        return ResultStore(RESULTS_PATH, ttl, max_entries, max_size)
+
+    @staticmethod
+    def _request_key(message):
+        """ Idempotency key (IQ id by default) of the sender """
+        key = u'%s:%s' % (message.from_.split('/')[0], message.request_key or message.id)
+        return key.encode('utf-8')
+
+    def _stored_result(self, request_key, message):
+        if not self.results:
+            return None
+
+        # Same key but another command or arguments (ids reused by the sender)
+        stored = self.results.get(request_key)
+        if not stored or stored[0] != message.command_key:
+            return None
+
+        result = stored[1]
+        extra = dict(result[5])
+        extra['stored'] = 1
+
+        return result[:5] + (extra,)
+
+    def _running_request(self, request_key, message):
+        """ Running request with this key and the same command and arguments """
+        return request_key in self._requests and self._requests[request_key][0] == message.command_key
+
+    def _replay(self, request_key, message):
+        message.command_name = message.command.replace('.', '_')
+
+        if not self.verify.signature(message):
+            self._send((_E_UNVERIFIED_COMMAND, '', 'Bad signature', 0), message)
+            return
+
+        message.command_args = {}
+
+        if self._running_request(request_key, message):
+            log.info("Request %s is running, waiting for its result" % request_key)
+            self._requests[request_key][1].append(message)
+            return
+
+        log.info("Request %s already finished, sending its stored result" % request_key)
+        self._send(self._stored_result(request_key, message), message)
+
+    def _store_result(self, result, message):
+        if self.results and self.command_runner.storable(message.command_name):
+            self.results.set(self._request_key(message), message.command_key, result)
+
+        return result
+
+    def _running_key(self, command_name, message):
+        key = self._concurrency.get(command_name, {}).get('key')
+
+        if key == KEY_REQUEST:
+            return '%s:%s' % (command_name, message.id)
+
+        if key:
+            if not isinstance(key, list):
+                key = [key]
+
+            return command_name + ':' + ','.join('%s=%s' % (arg, message.command_args.get(arg, '')) for arg in key)
+
+        return command_name
+
+    def _parallel(self, command_name):
+        return int(self._concurrency.get(command_name, {}).get('parallel', 0))
+
+    def _add_running(self, running_key, command_name, message):
+        self.running_commands[running_key] = (self.timestamp + int(message.command_args['timeout']),
+                                              command_name, message.id)
+        self.num_running_commands += 1
+        self._running_by_command[command_name] = self._running_by_command.get(command_name, 0) + 1
+
+    def _remove_running(self, running_key):
+        command_name = self.running_commands.pop(running_key)[1]
+        self.num_running_commands -= 1
+
+        self._running_by_command[command_name] -= 1
+        if not self._running_by_command[command_name]:
+            del self._running_by_command[command_name]
+
+    def _expire_running_commands(self):
+        now = time()
+        for running_key, (expiry, command_name, message_id) in self.running_commands.items():
+            if now > expiry:
+                log.debug("Deleted %s from running_commands dict as should have been completed" % running_key)
+                self._remove_running(running_key)
 
     def _processCommand(self, message):
+        message.command_name = message.command.replace('.', '_')
+
         if not self.verify.signature(message):
             result = (_E_UNVERIFIED_COMMAND, '', 'Bad signature', 0)
             self._onCallFinished(result, message)
             return
 
         flush_callback = self._flush
-        message.command_name = message.command.replace('.', '_')
+
+        # Unless another command runs with the same key
+        request_key = self._request_key(message)
+        if request_key not in self._requests:
+            self._requests[request_key] = (message.command_key, [])
 
         d = self.command_runner.run_command(message, flush_callback)
         
@@ -164,6 +315,7 @@ class SMAgentXMPP(Client):
         message.command_args = {}
 
         if d:
+            d.addCallback(self._store_result, message)
             d.addCallbacks(self._onCallFinished, self._onCallFailed,
                            callbackKeywords={'message': message},
                            errbackKeywords={'message': message},
@@ -181,9 +333,22 @@ class SMAgentXMPP(Client):
         
     def _onCallFinished(self, result, message):
         log.debug('Call Finished')
-        self._send(result, message)
-        del self.running_commands[message.command_name]
-        self.num_running_commands -= 1
+        waiting = []
+        request_key = self._request_key(message)
+        if self._running_request(request_key, message):
+            waiting = self._requests.pop(request_key)[1]
+
+        d = self._send(result, message)
+        d.addCallback(self._sent, message)
+
+        for waiting_message in waiting:
+            self._send(result, waiting_message)
+
+        # Coalesced requests have no key, expired ones may be taken again
+        running_key = getattr(message, 'running_key', None)
+        if running_key in self.running_commands and self.running_commands[running_key][2] == message.id:
+            self._remove_running(running_key)
+
         log.debug('command finished %s' %message.command_name)
 
     def _onCallFailed(self, failure, *argv, **kwargs):
@@ -193,21 +358,65 @@ class SMAgentXMPP(Client):
         if 'message' in kwargs:
             message = kwargs['message']
             result = (2, '', failure, 0)
-            del self.running_commands[message.command_name]
-            self.num_running_commands -= 1
             self._onCallFinished(result, message)
 
     def _flush(self, result, message):
         log.debug('Flush Message')
-        self._send(result, message)
+        self._send(result, message, PRIORITY_PARTIAL)
 
-    def _send(self, result, message):
+    def _send(self, result, message, priority=PRIORITY_RESULT):
+        """ Deferred fired once the result is queued """
         log.debug('Send Response')
         message.toResult(*result)
+        message.stream_compressed = self.compressed
 
         del result
 
-        self.send(message.toEtree())
+        streamed = priority == PRIORITY_RESULT and self._streamed(message)
+        if streamed:
+            d = succeed(None)
+            for name in streamed:
+                d.addCallback(self._send_stream, message, name)
+
+            d.addErrback(self._stream_failed, message)
+            d.addCallback(self._send_result, message, priority)
+            return d
+
+        self._send_result(None, message, priority)
+        return succeed(None)
+
+    def _send_result(self, result, message, priority):
+        # A partial result replaces the queued one, except delta ones and
+        # plugin data (they only carry new output)
+        replace = getattr(message, 'flush_mode', '') != 'delta' and not message.extra.get('data')
+        self.send(message.toEtree(), priority, (message.to, message.id), replace)
+
+    def _streamed(self, message):
+        """ Outputs sent in a bytestream before the result """
+        if not self.ibb_threshold:
+            return []
+
+        return [name for name in ('stdout', 'stderr') if len(getattr(message, name)) > self.ibb_threshold]
+
+    def _send_stream(self, result, message, name):
+        stream = IBBStream(self, message.to, message.from_, getattr(message, name), self.ibb_block_size)
+        log.info("Sending %s of %s in stream %s" % (name, message.command, stream.sid))
+
+        d = stream.start()
+        d.addCallback(self._stream_sent, message, name, stream.sid)
+        return d
+
+    @staticmethod
+    def _stream_sent(size, message, name, sid):
+        message.streams[name] = (sid, size)
+
+    @staticmethod
+    def _stream_failed(failure, message):
+        log.warn("Unable to stream the output of %s, sending it in the result" % message.command)
+        message.streams = {}
+
+    def _sent(self, result, message):
+        self.command_runner.sent(message)
 
     def _check_memory(self, num_running_commands):
         rss = mem_clean('periodic memory clean')
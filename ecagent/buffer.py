@@ -0,0 +1,182 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Output is read back from the spool file in mmap windows of this size
+SPOOL_CHUNK = 1024 * 1024
+
+import os
+import mmap
+import hashlib
+import tempfile
+
+
+class OutputBuffer:
+    def __init__(self, checksum=False, spool_size=0, spool_path=None):
+        """
+        Append only buffer for command output.
+
+        Appends are O(1) (data is kept as a list of chunks and only joined
+        when the whole value is needed) and since() returns the data written
+        after an offset without joining everything.
+
+        @param checksum: Keep a running sha1 of the written data.
+        @param spool_size: Bytes kept in memory, more output goes to a file
+        in spool_path and getvalue() returns a SpooledOutput (0: never).
+        """
+        self._chunks = []
+        self._size = 0
+        self._checksum = checksum
+        self._sha1 = checksum and hashlib.sha1() or None
+
+        self._spool_size = spool_size
+        self._spool_path = spool_path
+        self._spool = None
+
+    def __len__(self):
+        return self._size
+
+    def write(self, data):
+        if data:
+            if self._spool is not None:
+                _write_all(self._spool, data)
+            else:
+                self._chunks.append(data)
+
+            self._size += len(data)
+
+            if self._sha1:
+                self._sha1.update(data)
+
+            if self._spool is None and self._spool_size and self._size > self._spool_size:
+                self._start_spool()
+
+    def getvalue(self):
+        if self._spool is not None:
+            return SpooledOutput(os.dup(self._spool), self._size)
+
+        if len(self._chunks) > 1:
+            # Keep the joined value so next calls only join new chunks
+            self._chunks = [''.join(self._chunks)]
+
+        if self._chunks:
+            return self._chunks[0]
+
+        return ''
+
+    def since(self, offset):
+        """ Data written after offset (as returned by len()) """
+        offset = max(offset, 0)
+        pending = self._size - offset
+        if pending <= 0:
+            return ''
+
+        if self._spool is not None:
+            return _read(self._spool, offset, pending)
+
+        chunks = []
+        for chunk in reversed(self._chunks):
+            if pending <= 0:
+                break
+
+            if len(chunk) > pending:
+                chunk = chunk[-pending:]
+
+            chunks.append(chunk)
+            pending -= len(chunk)
+
+        chunks.reverse()
+        return ''.join(chunks)
+
+    def sha1(self):
+        if self._sha1:
+            return self._sha1.hexdigest()
+
+        if self._spool is not None:
+            sha1 = hashlib.sha1()
+            for chunk in self.getvalue().chunks():
+                sha1.update(chunk)
+            return sha1.hexdigest()
+
+        return hashlib.sha1(self.getvalue()).hexdigest()
+
+    def spooled(self):
+        return self._spool is not None
+
+    def reset(self):
+        self._chunks = []
+        self._size = 0
+        self._sha1 = self._checksum and hashlib.sha1() or None
+
+        if self._spool is not None:
+            os.close(self._spool)
+            self._spool = None
+
+    def _start_spool(self):
+        if not os.path.isdir(self._spool_path):
+            os.makedirs(self._spool_path, 0700)
+
+        # Unlinked at once: space is freed when the last SpooledOutput is gone
+        fd, filename = tempfile.mkstemp(prefix='output-', dir=self._spool_path)
+        os.unlink(filename)
+
+        _write_all(fd, ''.join(self._chunks))
+        self._chunks = []
+        self._spool = fd
+
+
+class SpooledOutput:
+    def __init__(self, fd, size):
+        """
+        Output spooled to a file by OutputBuffer, read in chunks
+        (mmap windows) so it's never whole in memory.
+        """
+        self._fd = fd
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self):
+        return ''.join(self.chunks())
+
+    def chunks(self, chunk_size=SPOOL_CHUNK):
+        offset = 0
+        while offset < self._size:
+            yield _read(self._fd, offset, min(chunk_size, self._size - offset))
+            offset += chunk_size
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __del__(self):
+        self.close()
+
+
+def _read(fd, offset, length):
+    # mmap offsets must be multiple of the allocation granularity
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    window = mmap.mmap(fd, length + offset - start, access=mmap.ACCESS_READ, offset=start)
+    try:
+        return window[offset - start:]
+    finally:
+        window.close()
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
@@ -0,0 +1,162 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-band bytestreams (XEP-0047) for the output of large results: the
+zlib compressed output goes in data IQs of a bounded size, read and
+compressed from the output buffer as they are acknowledged.
+"""
+
+NS_IBB = 'http://jabber.org/protocol/ibb'
+
+# Outputs over this size (bytes) are streamed, 0 never
+IBB_THRESHOLD = 1024 * 1024
+
+# Compressed bytes by data IQ (before base64)
+IBB_BLOCK_SIZE = 16 * 1024
+
+# Data IQs waiting to be acknowledged
+IBB_WINDOW = 4
+
+# System imports
+import zlib
+import base64
+from random import random
+
+# Twisted imports
+from twisted.internet.defer import Deferred
+from twisted.words.xish.domish import Element
+
+# Local
+import ecagent.twlogging as log
+from ecagent.buffer import SpooledOutput
+from ecagent.client import PRIORITY_CHUNK
+
+
+class IBBStream:
+    def __init__(self, client, to, from_, output, block_size=IBB_BLOCK_SIZE):
+        """
+        Sends output (str or SpooledOutput) to a JID in an in-band bytestream.
+
+        @param client: Client sending the IQs (send_iq).
+        @param block_size: Compressed bytes by data IQ.
+        """
+        self.sid = 'ecm-%d' % int(random() * (10 ** 12))
+        self.size = 0
+
+        self._client = client
+        self._to = to
+        self._from = from_
+        self._block_size = block_size
+        self._blocks = _blocks(output, block_size)
+
+        self._seq = 0
+        self._in_flight = 0
+        self._eof = False
+        self._deferred = None
+
+    def start(self):
+        """ Deferred fired with the compressed size once the stream is closed """
+        self._deferred = Deferred()
+
+        ibb_open = self._iq('open')
+        ibb_open['block-size'] = str(self._block_size)
+        ibb_open['stanza'] = 'iq'
+
+        d = self._client.send_iq(ibb_open.parent, PRIORITY_CHUNK)
+        d.addCallbacks(self._send_blocks, self._failed)
+
+        return self._deferred
+
+    def _send_blocks(self, result=None):
+        if self._deferred.called:
+            return
+
+        while not self._eof and self._in_flight < IBB_WINDOW:
+            try:
+                block = self._blocks.next()
+
+            except StopIteration:
+                self._eof = True
+                break
+
+            data = self._iq('data')
+            data['seq'] = str(self._seq)
+            data.addContent(base64.b64encode(block))
+
+            self._seq = (self._seq + 1) % 65536
+            self._in_flight += 1
+            self.size += len(block)
+
+            d = self._client.send_iq(data.parent, PRIORITY_CHUNK)
+            d.addCallbacks(self._acked, self._failed)
+            del block, data
+
+        if self._eof and not self._in_flight:
+            d = self._client.send_iq(self._iq('close').parent, PRIORITY_CHUNK)
+            d.addCallbacks(self._closed, self._failed)
+
+    def _acked(self, result):
+        self._in_flight -= 1
+        self._send_blocks()
+
+    def _closed(self, result):
+        log.debug("Stream %s to %s closed: %d bytes" % (self.sid, self._to, self.size))
+        self._deferred.callback(self.size)
+
+    def _failed(self, failure):
+        if not self._deferred.called:
+            log.warn("Stream %s to %s failed: %s" % (self.sid, self._to, failure.getErrorMessage()))
+            self._deferred.errback(failure)
+
+    def _iq(self, name):
+        """ Element name of a new IQ set """
+        iq = Element(('jabber:client', 'iq'))
+        iq['type'] = 'set'
+        iq['to'] = self._to
+        iq['from'] = self._from
+
+        element = iq.addElement((NS_IBB, name))
+        element['sid'] = self.sid
+
+        return element
+
+
+def _blocks(output, block_size):
+    """ zlib compressed output by blocks, reading a chunk at a time """
+    if isinstance(output, SpooledOutput):
+        chunks = output.chunks()
+    else:
+        chunks = [output]
+
+    compressor = zlib.compressobj()
+    pending = ''
+
+    for chunk in chunks:
+        pending += compressor.compress(chunk)
+        del chunk
+
+        offset = 0
+        while len(pending) - offset >= block_size:
+            yield pending[offset:offset + block_size]
+            offset += block_size
+
+        pending = pending[offset:]
+
+    pending += compressor.flush()
+
+    for offset in range(0, len(pending), block_size):
+        yield pending[offset:offset + block_size]
@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+CACHE_MAX_ENTRIES = 256
+CACHE_MAX_SIZE = 4 * 1024 * 1024
+
+# System imports
+from time import time
+from collections import OrderedDict
+
+
+class ResultCache:
+    def __init__(self, max_entries=CACHE_MAX_ENTRIES, max_size=CACHE_MAX_SIZE):
+        """
+        LRU cache of command results with a TTL per entry.
+
+        @param max_entries: Maximum number of cached results.
+        @param max_size: Maximum bytes of cached output (stdout + stderr).
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        entry = self._entries.pop(key, None)
+        if entry and entry[0] > time():
+            # Most recently used goes last
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+        if entry:
+            self._size -= entry[2]
+
+        self.misses += 1
+        return None
+
+    def set(self, key, result, ttl, tag=None):
+        """
+        @param result: (exit_code, stdout, stderr)
+        @param ttl: Seconds the result is valid.
+        @param tag: Group of entries for invalidate() (i.e. the plugin).
+        """
+        size = len(result[1]) + len(result[2])
+        if size > self.max_size:
+            return
+
+        self.delete(key)
+        self._entries[key] = (time() + ttl, result, size, tag)
+        self._size += size
+
+        while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_size):
+            self._size -= self._entries.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._size -= entry[2]
+
+    def invalidate(self, tag):
+        for key in [key for key, entry in self._entries.items() if entry[3] == tag]:
+            self.delete(key)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'size': self._size,
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -14,29 +14,48 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import heapq
+
 import ecagent.twlogging as log
 # Twisted imports
-from twisted.internet.defer import DeferredSemaphore
+from twisted.internet.defer import Deferred, DeferredSemaphore
+from twisted.internet.error import ConnectionLost
+from twisted.words.protocols.jabber.error import exceptionFromStanza
 from twisted.words.xish.domish import Element
 
 # Local
 from core import BasicClient
+from ecagent.flow import SEND_BUFFER_SIZE
+from ecagent.ping import Ping, NS_PING, PING_INTERVAL, PING_TIMEOUT, PING_FAILURES
 
 XMPP_HOST = 'xmpp.ecmanaged.net'
 
+# Outgoing stanzas order
+PRIORITY_RESULT = 0
+PRIORITY_CONTROL = 1
+PRIORITY_PARTIAL = 2
+PRIORITY_CHUNK = 3
+
 
 class Client(BasicClient):
-    def __init__(self, config, observers, resource='XMPPClient'):
+    def __init__(self, config, observers, resource='XMPPClient', producer=None):
         """
         XMPP Client class with ConfigObj, presence,
         concurrent message sending limit, and observers support.
 
+        Stanzas are queued and sent by priority: up to max_concurrent_messages
+        may be written while the transport send buffer is full, the rest wait.
+
         @param config: ConfigObj from where to read client settings.
         @param observers: Iterable of ("resource", callback') tuples.
+        @param producer: Streaming producer paused while the send buffer is full.
         """
         my_observers = [
             ('/presence', self._onPresence),
             ("/iq[@type='error']", self._onPossibleErrorIq),
+            ("/iq[@type='result']", self._onIqResult),
+            ("/iq[@type='get']/ping[@xmlns='%s']" % NS_PING, self._onPing),
+            ('/*', self._onReceived),
         ]
         my_observers.extend(observers)
 
@@ -50,7 +69,44 @@ class Client(BasicClient):
         if 'max_delay' in config:
             max_delay = self.cfg.as_int('max_delay')
 
+        compression = True
+        if 'compression' in config:
+            compression = config.as_bool('compression')
+
+        stream_management = True
+        if 'stream_management' in config:
+            stream_management = config.as_bool('stream_management')
+
+        ping_interval = PING_INTERVAL
+        if 'ping_interval' in config:
+            ping_interval = config.as_int('ping_interval')
+
+        ping_timeout = PING_TIMEOUT
+        if 'ping_timeout' in config:
+            ping_timeout = config.as_int('ping_timeout')
+
+        ping_failures = PING_FAILURES
+        if 'ping_failures' in config:
+            ping_failures = config.as_int('ping_failures')
+
+        send_buffer_size = SEND_BUFFER_SIZE
+        if 'send_buffer_size' in config:
+            send_buffer_size = config.as_int('send_buffer_size')
+
         self._concurrency_semaphore = DeferredSemaphore(max_concurrent)
+        self._send_buffer = SendBuffer(producer)
+
+        # [priority, sequence, element, key, replace], element is None once replaced
+        self._queue = []
+        self._sequence = 0
+        self._partials = {}
+        self.dropped_partials = 0
+
+        # IQ id -> Deferred fired with its response
+        self._iq_deferreds = {}
+
+        self.ping = Ping(self, XMPP_HOST, self._reconnect, ping_interval, ping_timeout, ping_failures)
+
         self._my_full_jid = '/'.join((config['user'] + '@' + XMPP_HOST, resource))
         BasicClient.__init__(self,
                              config['user'] + '@' + XMPP_HOST,
@@ -59,9 +115,158 @@ class Client(BasicClient):
                              my_observers,
                              resource=resource,
                              max_delay=max_delay,
+                             producer=self._send_buffer,
+                             send_buffer_size=send_buffer_size,
+                             compression=compression,
+                             stream_management=stream_management,
         )
 
+    def send(self, elem, priority=PRIORITY_CONTROL, key=None, replace=True):
+        """
+        Queues a stanza.
+
+        @param key: Partial results and the result of a request, sent in
+        the order they are queued.
+        @param replace: Drops the queued partials with the same key that
+        can be replaced (output snapshots, not delta or data ones).
+        """
+        partials = self._partials.get(key, [])
+        if replace:
+            for item in [item for item in partials if item[4]]:
+                partials.remove(item)
+                item[2] = None
+                self.dropped_partials += 1
+                log.debug("Dropped stale partial result %s" % (key,))
+
+        if partials and priority < PRIORITY_PARTIAL:
+            # The ones left go before the result instead of being overtaken by it
+            for item in partials:
+                item[0] = priority
+
+            heapq.heapify(self._queue)
+
+        if key in self._partials and (not partials or priority < PRIORITY_PARTIAL):
+            del self._partials[key]
+
+        item = [priority, self._sequence, elem, key, replace]
+        self._sequence += 1
+
+        if key is not None and priority == PRIORITY_PARTIAL:
+            self._partials.setdefault(key, []).append(item)
+
+        heapq.heappush(self._queue, item)
+        self._send_queued()
+
+    def send_iq(self, iq, priority=PRIORITY_CONTROL):
+        """
+        Queues an IQ, the Deferred fires with the result IQ or fails with
+        a StanzaError (error IQ) or ConnectionLost (stream end).
+        Cancelling it ignores the response.
+        """
+        if not iq.getAttribute('id'):
+            iq['id'] = self._newid()
+
+        d = Deferred(lambda d: self._cancel_iq(iq))
+        self._iq_deferreds[iq['id']] = d
+        self.send(iq, priority)
+
+        return d
+
+    def congested(self):
+        """ Stanzas wait for the send buffer to drain """
+        return self._send_buffer.full
+
+    def _cancel_iq(self, iq):
+        # Not sent yet: dropped
+        self._iq_deferreds.pop(iq['id'], None)
+        for item in self._queue:
+            if item[2] is iq:
+                item[2] = None
+
+    def _authd(self, xml_stream):
+        if not self.stream_management.resumed:
+            self._fail_iqs()
+
+        BasicClient._authd(self, xml_stream)
+        self._send_queued()
+        self.ping.start()
+
+    def _stream_end(self, error):
+        # A resumed session gets the responses
+        resumable = self.stream_management.enabled and self.stream_management.id
+        BasicClient._stream_end(self, error)
+        self.ping.stop()
+
+        if not resumable:
+            self._fail_iqs()
+
+    def _fail_iqs(self):
+        # Their responses won't come: not sent yet ones are dropped
+        pending, self._iq_deferreds = self._iq_deferreds, {}
+        for item in self._queue:
+            if item[2] is not None and item[2].getAttribute('id') in pending:
+                item[2] = None
+
+        for d in pending.values():
+            d.errback(ConnectionLost())
+
+    def _send_queued(self):
+        while self._queue and self.authenticated and self._concurrency_semaphore.tokens:
+            item = heapq.heappop(self._queue)
+            elem, key = item[2:4]
+            if key in self._partials and item in self._partials[key]:
+                self._partials[key].remove(item)
+                if not self._partials[key]:
+                    del self._partials[key]
+
+            if elem is None:
+                continue
+
+            self._concurrency_semaphore.acquire()
+            BasicClient.send(self, elem)
+
+            if self._send_buffer.full:
+                # Keeps the slot until the buffer is drained
+                self._send_buffer.wait().addCallback(self._buffer_drained)
+
+            else:
+                self._concurrency_semaphore.release()
+
+    def _buffer_drained(self, result):
+        # The server is reading what we send
+        self.ping.alive()
+        self._concurrency_semaphore.release()
+        self._send_queued()
+
+    def _reconnect(self):
+        """ The server doesn't answer: drops the connection to open a new one """
+        log.info("No answer to %d pings: Trying to reconnect" % self.ping.max_failures)
+        if self._xs and self._xs.transport:
+            self._xs.transport.abortConnection()
+
+    def _onReceived(self, elem):
+        self.ping.alive()
+
+    def _onPing(self, elem):
+        pong = Element(('jabber:client', 'iq'))
+        pong['type'] = 'result'
+        pong['id'] = elem['id']
+        if elem.getAttribute('from'):
+            pong['to'] = elem['from']
+
+        self.send(pong)
+
+    def _onIqResult(self, elem):
+        d = self._iq_deferreds.pop(elem.getAttribute('id'), None)
+        if d:
+            d.callback(elem)
+
     def _onPossibleErrorIq(self, elem):
+        d = self._iq_deferreds.pop(elem.getAttribute('id'), None)
+        if d:
+            d.errback(exceptionFromStanza(elem))
+            return
+
         sender = elem['from']
         for el in elem.elements():
             if el.name == 'error' and el['code'] == '404':
@@ -96,6 +301,49 @@ class Client(BasicClient):
         return False
 
 
+class SendBuffer:
+    def __init__(self, producer=None):
+        """
+        Streaming producer registered with the XMPP transport: tells if
+        its send buffer is full and passes pause/resume on to producer.
+        """
+        self.full = False
+        self._producer = producer
+        self._waiting = []
+
+    def wait(self):
+        """ Deferred fired once the send buffer is drained """
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def pauseProducing(self):
+        self.full = True
+        if self._producer:
+            self._producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.full = False
+        if self._producer:
+            self._producer.resumeProducing()
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    def stopProducing(self):
+        # Connection lost: queued stanzas wait for the next one, commands
+        # too (their output would pile up in the queue meanwhile)
+        log.info("Connection lost, pausing commands output until reconnected")
+        self.full = False
+        if self._producer:
+            self._producer.pauseProducing()
+
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(None)
+
+
 class XMPPPresence:
     def __init__(self, elem=None):
         if elem:
@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+XMPP stream compression (XEP-0138), zlib method.
+
+Negotiated after authentication when the server offers it: every byte
+written is compressed (flushed at the end of each write) and every byte
+received decompressed before the XML parser gets it.
+"""
+
+NS_COMPRESS_FEATURE = 'http://jabber.org/features/compress'
+NS_COMPRESS_PROTOCOL = 'http://jabber.org/protocol/compress'
+
+COMPRESSION_METHOD = 'zlib'
+
+# System imports
+import zlib
+
+# Twisted imports
+from twisted.internet import defer
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.xish.domish import Element
+
+import ecagent.twlogging as log
+
+
+class CompressInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    feature = (NS_COMPRESS_FEATURE, 'compression')
+    wanted = True
+    _deferred = None
+
+    def start(self):
+        methods = [str(method) for method in self.xmlstream.features[self.feature].elements()
+                   if method.name == 'method']
+
+        if not self.wanted or COMPRESSION_METHOD not in methods:
+            return defer.succeed(None)
+
+        self._deferred = defer.Deferred()
+        self.xmlstream.addOnetimeObserver('/compressed', self.onCompressed)
+        self.xmlstream.addOnetimeObserver('/failure', self.onFailure)
+
+        compress = Element((NS_COMPRESS_PROTOCOL, 'compress'))
+        compress.addElement('method', content=COMPRESSION_METHOD)
+        self.xmlstream.send(compress)
+
+        return self._deferred
+
+    def onCompressed(self, obj):
+        self.xmlstream.removeObserver('/failure', self.onFailure)
+
+        start_compression(self.xmlstream)
+        log.info("XMPP stream compression started")
+
+        self.xmlstream.reset()
+        self.xmlstream.sendHeader()
+        self._deferred.callback(xmlstream.Reset)
+
+    def onFailure(self, obj):
+        # Not required: go on uncompressed
+        self.xmlstream.removeObserver('/compressed', self.onCompressed)
+        log.warn("XMPP stream compression refused by the server")
+        self._deferred.callback(None)
+
+
+class CompressedTransport:
+    def __init__(self, transport):
+        """
+        Transport wrapper compressing written data, anything else
+        (producers, bufferSize...) goes to the wrapped transport.
+        """
+        self.__dict__['_transport'] = transport
+        self.__dict__['_compressor'] = zlib.compressobj()
+
+    def write(self, data):
+        if data:
+            self._transport.write(self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH))
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._transport, name, value)
+
+
+def start_compression(xs):
+    """ Compresses everything written to and read from the stream from now on """
+    decompressor = zlib.decompressobj()
+    data_received = xs.dataReceived
+
+    def decompress(data):
+        data_received(decompressor.decompress(data))
+
+    xs.transport = CompressedTransport(xs.transport)
+    xs.dataReceived = decompress
+
+
+def is_compressed(xs):
+    return isinstance(xs.transport, CompressedTransport)
@@ -20,7 +20,7 @@ XMPP_PORT = 5222
 from random import random
 
 # Twisted imports
-from twisted.words.protocols.jabber import client, jid, xmlstream
+from twisted.words.protocols.jabber import client, jid, xmlstream, sasl
 from twisted.words.xish.domish import Element
 from twisted.internet import reactor
 from twisted.words.protocols.jabber.xmlstream import STREAM_END_EVENT
@@ -28,12 +28,41 @@ from twisted.words.protocols.jabber.client import IQ
 
 # Local
 import twlogging as log
+from compression import CompressInitializer, is_compressed
+from streammanagement import StreamManagement, ResumeInitializer, EnableInitializer
+
+
+# Replaced below
+_XMPPAuthenticator = client.XMPPAuthenticator
 
 
 # Add registerAccount to XMPPAuthenticator
-class FixedXMPPAuthenticator(client.XMPPAuthenticator):
+class FixedXMPPAuthenticator(_XMPPAuthenticator):
     AUTH_FAILED_EVENT = "//event/client/xmpp/authfailed"
 
+    # Stream compression (XEP-0138) when offered
+    compression = True
+
+    # StreamManagement (XEP-0198), kept between connections
+    stream_management = None
+
+    def associateWithStream(self, xs):
+        _XMPPAuthenticator.associateWithStream(self, xs)
+
+        # Offered once authenticated
+        compress = CompressInitializer(xs, required=False)
+        compress.wanted = self.compression
+        for index, initializer in enumerate(xs.initializers):
+            if isinstance(initializer, sasl.SASLInitiatingInitializer):
+                xs.initializers.insert(index + 1, compress)
+                break
+
+        if self.stream_management:
+            # Resumed instead of binding, enabled once bound
+            resume = ResumeInitializer(xs, self.stream_management)
+            xs.initializers.insert(xs.initializers.index(compress) + 1, resume)
+            xs.initializers.append(EnableInitializer(xs, self.stream_management))
+
     def registerAccount(self, username=None, password=None):
         if username:
             self.jid.user = username
@@ -62,7 +91,8 @@ client.XMPPAuthenticator = FixedXMPPAuthenticator
 
 class BasicClient:
     def __init__(self, user, password, host, observers,
-                 resource="XMPPBasicClient", max_delay=60):
+                 resource="XMPPBasicClient", max_delay=60, producer=None, send_buffer_size=None,
+                 compression=True, stream_management=True):
         """
         Basic XMPP Client class.
 
@@ -71,6 +101,10 @@ class BasicClient:
         @param host: XMPP server address.
         @param observers: Dictionary of observers.
         @param resource: Resource to use when sending messages by default.
+        @param producer: Streaming producer paused while the send buffer is full.
+        @param send_buffer_size: Send buffer bytes that pause the producer.
+        @param compression: Use stream compression if the server offers it.
+        @param stream_management: Acks and session resumption if the server offers it.
         """
 
         # use_http = False
@@ -79,6 +113,9 @@ class BasicClient:
         # self._factory = HTTPBindingStreamFactory(auth)
 
         self.failed_count = 0
+        self.authenticated = False
+        self.compressed = False
+        self.stream_management = StreamManagement(stream_management)
 
         self._xs = None
         self._user = user
@@ -87,6 +124,8 @@ class BasicClient:
         self._port = XMPP_PORT
 
         self._observers = observers
+        self._producer = producer
+        self._send_buffer_size = send_buffer_size
         myJid = jid.JID('/'.join((user, resource)))
 
         self._factory = client.XMPPClientFactory(myJid, password)
@@ -96,6 +135,8 @@ class BasicClient:
         self._factory.addBootstrap(xmlstream.STREAM_END_EVENT, self._stream_end)
         self._factory.addBootstrap(xmlstream.INIT_FAILED_EVENT, self._failed_auth)
         self._factory.maxDelay = max_delay
+        self._factory.authenticator.compression = compression
+        self._factory.authenticator.stream_management = self.stream_management
 
         #        if(use_http):
         #            connector = HTTPBClientConnector(str(url))
@@ -127,6 +168,9 @@ class BasicClient:
     def _stream_end(self, error):
         """ overwrite in derivated class """
         log.info("XMPPClient stream end")
+        self.authenticated = False
+        self.compressed = False
+        self.stream_management.stop()
 
     def _connected(self, xml_stream):
         log.info("XMPPClient connected")
@@ -139,12 +183,37 @@ class BasicClient:
         This method gets called when login has been successful.
         """
         log.info("XMPPClient authenticated")
+        self.authenticated = True
+        self.compressed = is_compressed(xml_stream)
 
         for message, callable in self._observers:
             self._xs.addObserver(message, callable)
 
-        presence = Element(('jabber:client', 'presence'))
-        self._xs.send(presence)
+        if self._producer:
+            self._register_producer(xml_stream.transport)
+
+        # Stanzas not acked on the previous stream go first
+        self.stream_management.start(xml_stream)
+
+        # A resumed session keeps its presence
+        if not self.stream_management.resumed:
+            presence = Element(('jabber:client', 'presence'))
+            BasicClient.send(self, presence)
+
+    def _register_producer(self, transport):
+        # Once authenticated: TLS is already started
+        if self._send_buffer_size:
+            transport.bufferSize = self._send_buffer_size
+
+        try:
+            transport.registerProducer(self._producer, True)
+
+        except RuntimeError:
+            # Already registered (authenticated again on the same connection)
+            pass
+
+        # Paused while disconnected
+        self._producer.resumeProducing()
 
     def _newid(self):
         return str(int(random() * (10 ** 31)))
@@ -154,4 +223,4 @@ class BasicClient:
             log.debug('No message ID in message, creating one')
             elem['id'] = self._newid()
 
-        self._xs.send(elem.toXml())
+        self.stream_management.send(self._xs, elem.toXml())
@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+# Bytes waiting in the XMPP transport before commands output is paused
+SEND_BUFFER_SIZE = 256 * 1024
+
+import ecagent.twlogging as log
+
+
+class FlowControl:
+    def __init__(self):
+        """
+        Streaming producer for the XMPP transport: when its send buffer
+        goes over the transport bufferSize (high water) the output of every
+        running command is paused (plugins block writing to the pipe), it's
+        resumed once the buffer is drained (low water) and, if the
+        connection is lost, once authenticated again.
+        """
+        self.paused = False
+        self.pauses = 0
+        self._producers = set()
+
+    def add(self, producer):
+        """ Process transport (or anything with pause/resumeProducing) """
+        self._producers.add(producer)
+        if self.paused:
+            producer.pauseProducing()
+
+    def remove(self, producer):
+        self._producers.discard(producer)
+
+    def pauseProducing(self):
+        if self.paused:
+            return
+
+        log.info("Pausing output of %d commands" % len(self._producers))
+        self.paused = True
+        self.pauses += 1
+
+        for producer in list(self._producers):
+            producer.pauseProducing()
+
+    def resumeProducing(self):
+        if not self.paused:
+            return
+
+        log.info("Resuming commands output")
+        self.paused = False
+
+        for producer in list(self._producers):
+            producer.resumeProducing()
+
+    def stopProducing(self):
+        # Not registered with a transport itself (SendBuffer keeps it paused while disconnected)
+        self.resumeProducing()
+
+    def stats(self):
+        return {'paused': self.paused, 'pauses': self.pauses}
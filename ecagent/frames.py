@@ -0,0 +1,103 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Frames protocol between the runner and plugins (see plugins/__plugin.py).
+
+Every frame is a type byte, the payload length (4 bytes, big endian)
+and the payload:
+    A: command arguments (json, runner -> plugin on stdin)
+    O: output text
+    D: partial data (json)
+    R: command result (json)
+"""
+
+PROTOCOL_FRAMES = 'frames'
+
+FRAME_ARGS = 'A'
+FRAME_OUTPUT = 'O'
+FRAME_DATA = 'D'
+FRAME_RESULT = 'R'
+
+FRAME_TYPES = [FRAME_ARGS, FRAME_OUTPUT, FRAME_DATA, FRAME_RESULT]
+FRAME_HEADER = '>cI'
+
+# System imports
+import struct
+
+_HEADER_SIZE = struct.calcsize(FRAME_HEADER)
+
+
+class FrameError(Exception):
+    def __init__(self, message, frames=None):
+        """ frames: the ones read before the error """
+        Exception.__init__(self, message)
+        self.frames = frames or []
+
+
+def encode_frame(frame_type, payload):
+    return struct.pack(FRAME_HEADER, frame_type, len(payload)) + payload
+
+
+class FrameReader:
+    def __init__(self):
+        """
+        Splits a stream in frames. Data is only joined once a whole
+        header or payload is available, then read from an offset.
+        """
+        self._chunks = []
+        self._size = 0
+        self._header = None
+
+    def feed(self, data):
+        """ Returns a list of (type, payload) for the frames completed by data """
+        self._chunks.append(data)
+        self._size += len(data)
+
+        if self._size < self._needed():
+            return []
+
+        data = ''.join(self._chunks)
+        offset = 0
+
+        frames = []
+        while True:
+            if self._header is None:
+                if len(data) - offset < _HEADER_SIZE:
+                    break
+
+                self._header = struct.unpack_from(FRAME_HEADER, data, offset)
+                offset += _HEADER_SIZE
+                if self._header[0] not in FRAME_TYPES:
+                    raise FrameError("Invalid frame type %r" % self._header[0], frames)
+
+            if len(data) - offset < self._header[1]:
+                break
+
+            frames.append((self._header[0], data[offset:offset + self._header[1]]))
+            offset += self._header[1]
+            self._header = None
+
+        self._chunks = offset < len(data) and [data[offset:]] or []
+        self._size = len(data) - offset
+
+        return frames
+
+    def _needed(self):
+        if self._header is None:
+            return _HEADER_SIZE
+
+        return self._header[1]
@@ -14,7 +14,9 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from os import getpid
+from os import getpid, listdir
+from hashlib import sha1
+import simplejson as json
 
 try:
     import psutil
@@ -50,4 +52,43 @@ def mem_clean(where=''):
 
     del _collect, where, vms, string
 
-    return rss
\ No newline at end of file
+    return rss
+
+
+def command_key(command_name, command_args, ignore=('timeout',)):
+    """
+    Identifies a command call: command name and a hash of its
+    arguments in canonical form (sorted keys), run options are ignored.
+    """
+    args = dict((key, value) for key, value in command_args.items() if key not in ignore)
+    return command_name + ':' + sha1(json.dumps(args, sort_keys=True)).hexdigest()
+
+
+def session_pids(sid):
+    """
+    Processes in a session (a command and everything it forked,
+    unless they detached with setsid). Linux only, [] elsewhere.
+    """
+    pids = []
+    try:
+        for entry in listdir('/proc'):
+            if not entry.isdigit():
+                continue
+
+            try:
+                f = open('/proc/%s/stat' % entry)
+                stat = f.read()
+                f.close()
+
+            except IOError:
+                # Already gone
+                continue
+
+            # pid (comm) state ppid pgrp session ...
+            if int(stat.rsplit(')', 1)[1].split()[3]) == sid:
+                pids.append(int(entry))
+
+    except OSError:
+        pass
+
+    return pids
@@ -0,0 +1,336 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+_MANIFEST_VERSION = 2
+_BASE_MODULE = '__plugin'
+_BASE_CLASS = 'ECMPlugin'
+_COMMAND_PREFIX = 'cmd_'
+_CACHE_TTL = 'CACHE_TTL'
+_PROTOCOLS = '_PROTOCOLS'
+
+# System imports
+import os
+import ast
+import hashlib
+import simplejson as json
+
+import ecagent.twlogging as log
+
+
+class CommandManifest:
+    def __init__(self, filename):
+        """
+        Persistent plugin -> commands, CACHE_TTL and protocols map, only
+        valid while the plugin (and its __plugin.py base) keeps the same
+        mtime and hash.
+
+        @param filename: File where the manifest is stored.
+        """
+        self.filename = filename
+        self._plugins = {}
+        self._load()
+
+    def get(self, plugin):
+        """ Entry of a plugin (commands, cache_ttl, protocols) or None """
+        entry = self._plugins.get(plugin)
+        if not entry:
+            return None
+
+        for path, stored in entry['files'].items():
+            signature = file_signature(path, stored)
+            if not signature or signature['sha1'] != stored['sha1']:
+                del self._plugins[plugin]
+                return None
+
+            # Touched but not changed
+            entry['files'][path] = signature
+
+        return entry
+
+    def set(self, plugin, commands, cache_ttl, protocols):
+        files = {}
+        for path in [plugin, base_filename(plugin)]:
+            signature = file_signature(path)
+            if not signature:
+                return
+            files[path] = signature
+
+        self._plugins[plugin] = {'commands': commands, 'cache_ttl': cache_ttl, 'protocols': protocols,
+                                 'files': files}
+
+    def discover(self, plugin):
+        """
+        Returns (commands, cache_ttl, protocols) of a plugin from the
+        manifest or from its source code, commands is None when they can
+        only be known by running it.
+        """
+        entry = self.get(plugin)
+        if entry is None:
+            commands = static_commands(plugin)
+            cache_ttl = static_cache_ttl(plugin)
+            protocols = static_protocols(plugin)
+            self.set(plugin, commands, cache_ttl, protocols)
+
+            return commands, cache_ttl, protocols
+
+        return entry['commands'], entry['cache_ttl'], entry['protocols']
+
+    def save(self):
+        try:
+            path = os.path.dirname(self.filename)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+            tmp_file = self.filename + '.tmp'
+            f = open(tmp_file, 'w')
+            f.write(json.dumps({'version': _MANIFEST_VERSION, 'plugins': self._plugins}))
+            f.close()
+            os.rename(tmp_file, self.filename)
+
+        except Exception, e:
+            log.error("Unable to write command manifest %s: %s" % (self.filename, e))
+
+    def _load(self):
+        try:
+            if os.path.isfile(self.filename):
+                f = open(self.filename, 'r')
+                data = json.loads(f.read())
+                f.close()
+
+                if data.get('version') == _MANIFEST_VERSION:
+                    self._plugins = data.get('plugins', {})
+
+        except Exception, e:
+            log.warn("Ignoring invalid command manifest %s: %s" % (self.filename, e))
+            self._plugins = {}
+
+
+def file_signature(path, stored=None):
+    """
+    Returns mtime, size and sha1 of a file. When stored matches
+    mtime and size the file is not read again.
+    """
+    try:
+        st = os.stat(path)
+
+    except OSError:
+        return None
+
+    if stored and stored.get('mtime') == st.st_mtime and stored.get('size') == st.st_size:
+        return stored
+
+    try:
+        f = open(path, 'rb')
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+        f.close()
+
+    except IOError:
+        return None
+
+    return {'mtime': st.st_mtime, 'size': st.st_size, 'sha1': sha1}
+
+
+def base_filename(plugin):
+    return os.path.join(os.path.dirname(plugin), _BASE_MODULE + '.py')
+
+
+def static_commands(filename):
+    """
+    Reads the cmd_* methods of a plugin from its source (like
+    ECMPlugin._list_commands() does at run time).
+    Returns None when that can't be decided without running it.
+    """
+    if os.path.splitext(filename)[1] != '.py':
+        return None
+
+    module = _parse(filename)
+    base = _parse(base_filename(filename))
+    if not module or not base:
+        return None
+
+    base_commands = _class_commands(base).get(_BASE_CLASS)
+    base_names = _imported_names(module, _BASE_MODULE, _BASE_CLASS)
+    if base_commands is None or not base_names:
+        return None
+
+    classes = _class_commands(module)
+    bases = _class_bases(module)
+
+    def resolve(name, seen):
+        if name in base_names:
+            return set(base_commands)
+
+        if name not in classes or name in seen:
+            return None
+
+        commands = set(classes[name])
+        for parent in bases[name]:
+            parent_commands = resolve(parent, seen + [name])
+            if parent_commands is None:
+                return None
+            commands |= parent_commands
+
+        return commands
+
+    targets = _run_targets(module.body)
+    if not targets:
+        return None
+
+    commands = None
+    for target in targets:
+        target_commands = resolve(target, [])
+        if target_commands is None:
+            return None
+
+        # Plugin runs a different class depending on the platform
+        if commands is not None and commands != target_commands:
+            return None
+
+        commands = target_commands
+
+    return sorted(command[len(_COMMAND_PREFIX):] for command in commands)
+
+
+def static_cache_ttl(filename):
+    """
+    Reads the module level CACHE_TTL = {'command': seconds} of a plugin.
+    """
+    if os.path.splitext(filename)[1] != '.py':
+        return {}
+
+    module = _parse(filename)
+    if not module:
+        return {}
+
+    try:
+        cache_ttl = _module_constant(module, _CACHE_TTL) or {}
+        return dict((str(command), int(ttl)) for command, ttl in cache_ttl.items())
+
+    except Exception, e:
+        log.warn("Invalid %s in %s: %s" % (_CACHE_TTL, filename, e))
+        return {}
+
+
+def static_protocols(filename):
+    """
+    Protocols a plugin speaks besides the default one: the _PROTOCOLS
+    of __plugin.py for ECMPlugin based plugins.
+    """
+    if os.path.splitext(filename)[1] != '.py':
+        return []
+
+    module = _parse(filename)
+    base = _parse(base_filename(filename))
+    if not module or not base or not _imported_names(module, _BASE_MODULE, _BASE_CLASS):
+        return []
+
+    try:
+        return list(_module_constant(base, _PROTOCOLS) or [])
+
+    except Exception, e:
+        log.warn("Invalid %s in %s: %s" % (_PROTOCOLS, base_filename(filename), e))
+        return []
+
+
+def _module_constant(module, name):
+    for node in module.body:
+        if isinstance(node, ast.Assign) and [target.id for target in node.targets
+                                             if isinstance(target, ast.Name)] == [name]:
+            return ast.literal_eval(node.value)
+
+    return None
+
+
+def _parse(filename):
+    try:
+        f = open(filename, 'r')
+        source = f.read()
+        f.close()
+        return ast.parse(source, filename)
+
+    except Exception, e:
+        log.debug("Unable to parse %s: %s" % (filename, e))
+        return None
+
+
+def _imported_names(module, module_name, name):
+    names = set()
+    for node in module.body:
+        if isinstance(node, ast.ImportFrom) and node.module == module_name:
+            for alias in node.names:
+                if alias.name == name:
+                    names.add(alias.asname or alias.name)
+
+    return names
+
+
+def _class_commands(module):
+    classes = {}
+    for node in module.body:
+        if isinstance(node, ast.ClassDef):
+            classes[node.name] = [item.name for item in node.body
+                                  if isinstance(item, ast.FunctionDef) and item.name.startswith(_COMMAND_PREFIX)]
+
+    return classes
+
+
+def _class_bases(module):
+    bases = {}
+    for node in module.body:
+        if isinstance(node, ast.ClassDef):
+            # Only plain names can be resolved
+            bases[node.name] = [base.id if isinstance(base, ast.Name) else None for base in node.bases]
+
+    return bases
+
+
+def _run_call(node):
+    """ Class name for a "ClassName().run()" statement """
+    if not isinstance(node, ast.Expr) or not isinstance(node.value, ast.Call):
+        return None
+
+    func = node.value.func
+    if not isinstance(func, ast.Attribute) or func.attr != 'run':
+        return None
+
+    if isinstance(func.value, ast.Call) and isinstance(func.value.func, ast.Name):
+        return func.value.func.id
+
+    return None
+
+
+def _run_targets(body):
+    """
+    Classes that may be run by a block of module level statements,
+    None if some path doesn't run any.
+    """
+    targets = set()
+    for node in body:
+        name = _run_call(node)
+        if name:
+            targets.add(name)
+            return targets
+
+        if isinstance(node, ast.If):
+            if_targets = _run_targets(node.body)
+            else_targets = _run_targets(node.orelse)
+
+            if if_targets is not None and else_targets is not None:
+                return targets | if_targets | else_targets
+
+            targets |= (if_targets or set()) | (else_targets or set())
+
+    return None
@@ -15,6 +15,7 @@
 #    under the License.
 
 # System imports
+import re
 import zlib
 import base64
 
@@ -23,10 +24,17 @@ from twisted.words.xish.domish import Element
 
 # Local
 import ecagent.twlogging as log
+from ecagent.buffer import SpooledOutput
 
 AGENT_VERSION_CORE = 3
 AGENT_VERSION_PROTOCOL = 1
 
+# Plain stdout/stderr elements instead of gzip_stdout/gzip_stderr
+ENCODING_TEXT = 'text'
+
+# Characters not allowed in XML 1.0
+_XML_INVALID = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
 
 class IqMessage:
     """
@@ -44,6 +52,23 @@ class IqMessage:
         </ecm_message>
     </iq>
 
+    Optional ecm_message attributes:
+        flush="delta": partial results only carry the output added since
+        the previous one (see CommandRunnerProcess).
+        request_key="...": idempotency key, a request with the key of a
+        running or finished one gets its result (default: the IQ id).
+        encoding="text": when the XMPP stream is compressed, output that is
+        valid XML text goes in stdout/stderr elements as is instead of
+        zlib and base64 in gzip_stdout/gzip_stderr.
+
+    Partial results with data="1" carry json sent by the plugin
+    (ECMPlugin.partial()) instead of the command output.
+
+    Large outputs of final results may be sent before the result in an
+    in-band bytestream (XEP-0047) of zlib compressed data, then
+    gzip_stdout/gzip_stderr are empty with the stream id in its
+    stream attribute.
+
     """
 
     def __init__(self, elem=None):
@@ -59,6 +84,10 @@ class IqMessage:
                     raise Exception(
                         "Message format (%s) is greater than supported version (%s)" % (self.version, AGENT_VERSION_PROTOCOL))
 
+                self.flush_mode = el_ecm_message.getAttribute('flush', '')
+                self.request_key = el_ecm_message.getAttribute('request_key', '')
+                self.encoding = el_ecm_message.getAttribute('encoding', '')
+
                 self.type = elem['type']
                 self.id = elem['id']
                 self.to = elem['to']
@@ -89,6 +118,9 @@ class IqMessage:
             self.from_ = ''
             self.to = ''
             self.resource = ''
+            self.flush_mode = ''
+            self.request_key = ''
+            self.encoding = ''
 
         # Clean
         del elem
@@ -112,9 +144,40 @@ class IqMessage:
             result['timed_out'] = self.timed_out
             result['partial'] = self.partial
 
-            # compress out
-            result.addElement('gzip_stdout').addContent(base64.b64encode(zlib.compress(self.stdout)))
-            result.addElement('gzip_stderr').addContent(base64.b64encode(zlib.compress(self.stderr)))
+            for key in sorted(self.extra.keys()):
+                result[key] = str(self.extra[key])
+
+            # Plain text if the XMPP stream compresses it already
+            stdout = stderr = None
+            streams = getattr(self, 'streams', {})
+            if not streams and self.encoding == ENCODING_TEXT and getattr(self, 'stream_compressed', False):
+                stdout = _text(self.stdout)
+                stderr = _text(self.stderr)
+
+            if stdout is not None and stderr is not None:
+                # Compressed by the stream, size unknown
+                self.compressed_size = None
+
+                result.addElement('stdout').addContent(stdout)
+                result.addElement('stderr').addContent(stderr)
+
+            else:
+                # compress out (sent already if streamed)
+                self.compressed_size = 0
+                for name, output in (('stdout', self.stdout), ('stderr', self.stderr)):
+                    element = result.addElement('gzip_' + name)
+
+                    if name in streams:
+                        element['stream'], size = streams[name]
+                    else:
+                        compressed, size = _compress(output)
+                        element.addContent(compressed)
+                        del compressed
+
+                    self.compressed_size += size
+                del output
+
+            del stdout, stderr
             del ecm_message
 
         return msg
@@ -122,19 +185,75 @@ class IqMessage:
     def toXml(self):
         return self.toXml()
 
-    def toResult(self, retvalue, stdout, stderr, timed_out, partial=0):
-        """ Converts a query message to a result message. """
+    def toResult(self, retvalue, stdout, stderr, timed_out, partial=0, extra=None):
+        """
+        Converts a query message to a result message.
+        extra: additional attributes for the result element.
+        """
         # Don't switch to/from if already is a result
         if self.type != 'result':
             self.from_, self.to = self.to, self.from_
             self.type = 'result'
 
         self.retvalue = str(retvalue)
-        self.stdout = str(stdout)
-        self.stderr = str(stderr)
+        self.stdout = _output(stdout)
+        self.stderr = _output(stderr)
         self.timed_out = str(timed_out)
         self.partial = str(partial)
+        self.extra = extra or {}
+        self.streams = {}
         self.command_args = {}
 
-        del retvalue, stdout, stderr, timed_out, partial
+        del retvalue, stdout, stderr, timed_out, partial, extra
+
+
+def _output(output):
+    # Spooled output is only read while compressing
+    if isinstance(output, SpooledOutput):
+        return output
+
+    return str(output)
+
+
+def _text(output):
+    """ Output as unicode if it can go in XML as is, None otherwise """
+    if isinstance(output, SpooledOutput):
+        return None
+
+    try:
+        text = output.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+    if _XML_INVALID.search(text):
+        return None
+
+    return text
+
+
+def _compress(output):
+    """ base64 of the zlib compressed output and the compressed size """
+    if isinstance(output, SpooledOutput):
+        chunks = output.chunks()
+    else:
+        chunks = [output]
+
+    compressor = zlib.compressobj()
+    encoded = []
+    pending = ''
+    size = 0
+
+    for chunk in chunks:
+        pending += compressor.compress(chunk)
+
+        # base64 by groups of 3 bytes
+        length = len(pending) - len(pending) % 3
+        encoded.append(base64.b64encode(pending[:length]))
+        size += length
+        pending = pending[length:]
+
+    pending += compressor.flush()
+    encoded.append(base64.b64encode(pending))
+    size += len(pending)
 
+    return ''.join(encoded), size
@@ -0,0 +1,152 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+XMPP ping (XEP-0199) liveness check of the server connection.
+"""
+
+NS_PING = 'urn:xmpp:ping'
+
+# Seconds between pings
+PING_INTERVAL = 60
+
+# Seconds to wait for the answer
+PING_TIMEOUT = 30
+
+# Unanswered pings in a row before reconnecting
+PING_FAILURES = 3
+
+# Weight of the last RTT in the average
+PING_RTT_WEIGHT = 0.2
+
+# System imports
+from time import time
+
+# Twisted imports
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
+from twisted.words.protocols.jabber.error import StanzaError
+from twisted.words.xish.domish import Element
+
+import ecagent.twlogging as log
+
+
+class Ping:
+    def __init__(self, client, host, on_dead, interval=PING_INTERVAL, timeout=PING_TIMEOUT,
+                 failures=PING_FAILURES):
+        """
+        Pings the server while the stream is authenticated, on_dead is
+        called after failures unanswered pings in a row. Anything else
+        showing the connection works (see alive) counts as an answer.
+
+        @param client: Client sending the IQs (send_iq, congested).
+        @param host: Server domain.
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self.max_failures = failures
+
+        self.rtt = None
+        self.rtt_avg = None
+        self.failures = 0
+        self.lost = 0
+        self.last_alive = 0
+
+        self._client = client
+        self._host = host
+        self._on_dead = on_dead
+        self._pending = None
+        self._loop = LoopingCall(self._ping)
+
+    def start(self):
+        if self.interval and not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+        self.failures = 0
+        if self._pending:
+            self._pending.cancel()
+
+    def stats(self):
+        return {'rtt': self.rtt, 'rtt_avg': self.rtt_avg, 'failures': self.failures, 'lost': self.lost}
+
+    def alive(self):
+        """ Data received from the server or sent to it """
+        self.last_alive = time()
+        self.failures = 0
+
+    def _ping(self):
+        if self._pending:
+            return
+
+        if self._client.congested():
+            # It would wait behind the output being sent, pinged next time
+            log.debug("Send buffer full, ping delayed")
+            return
+
+        iq = Element(('jabber:client', 'iq'))
+        iq['type'] = 'get'
+        iq['to'] = self._host
+        iq.addElement((NS_PING, 'ping'))
+
+        d = self._client.send_iq(iq)
+        self._pending = d
+
+        timeout = reactor.callLater(self.timeout, d.cancel)
+        d.addBoth(self._answered, time(), timeout)
+
+    def _answered(self, result, sent, timeout):
+        self._pending = None
+        if timeout.active():
+            timeout.cancel()
+
+        # An error answer (ping not supported) is an answer as well
+        if isinstance(result, Failure) and not result.check(StanzaError):
+            self._failed(result, sent)
+            return
+
+        rtt = round(time() - sent, 4)
+        self.rtt = rtt
+        if self.rtt_avg is None:
+            self.rtt_avg = rtt
+        else:
+            self.rtt_avg = round(self.rtt_avg + PING_RTT_WEIGHT * (rtt - self.rtt_avg), 4)
+
+        self.failures = 0
+        log.debug("Ping answered in %.3fs" % rtt)
+
+    def _failed(self, failure, sent):
+        if not self._loop.running:
+            # Stream ended meanwhile
+            return
+
+        if self.last_alive >= sent:
+            # Slow to answer but the connection works
+            log.debug("Ping to %s unanswered, connection alive" % self._host)
+            return
+
+        self.failures += 1
+        self.lost += 1
+        log.warn("Ping to %s unanswered (%d/%d): %s" % (self._host, self.failures, self.max_failures,
+                                                          failure.getErrorMessage()))
+
+        if self.failures >= self.max_failures:
+            self.failures = 0
+            self._on_dead()
@@ -0,0 +1,168 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+RESULT_STORE_TTL = 3600
+RESULT_STORE_MAX_ENTRIES = 1024
+RESULT_STORE_MAX_SIZE = 16 * 1024 * 1024
+
+# System imports
+import os
+import base64
+from hashlib import sha1
+from time import time
+import simplejson as json
+
+import ecagent.twlogging as log
+from ecagent.buffer import SpooledOutput
+
+
+class ResultStore:
+    def __init__(self, path, ttl=RESULT_STORE_TTL, max_entries=RESULT_STORE_MAX_ENTRIES,
+                 max_size=RESULT_STORE_MAX_SIZE):
+        """
+        Finished results on disk (a file per request key), so a resent
+        request gets the result instead of running the command again.
+
+        @param ttl: Seconds a result is kept.
+        @param max_entries: Maximum number of stored results.
+        @param max_size: Maximum bytes of stored files.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_size = max_size
+
+        # file name -> (mtime, size)
+        self._files = {}
+        self._size = 0
+
+        self._load()
+
+    def get(self, key):
+        """ Returns (command key, result) or None """
+        name = self._name(key)
+        if name not in self._files:
+            return None
+
+        if self._expired(name):
+            self._delete(name)
+            return None
+
+        try:
+            f = open(os.path.join(self.path, name), 'r')
+            data = json.loads(f.read())
+            f.close()
+
+            if data['key'] != key:
+                return None
+
+            result = data['result']
+            result[1] = base64.b64decode(result[1])
+            result[2] = base64.b64decode(result[2])
+
+        except Exception, e:
+            log.error("Unable to read stored result %s: %s" % (name, e))
+            self._delete(name)
+            return None
+
+        return data.get('command_key'), tuple(result)
+
+    def set(self, key, command_key, result):
+        """
+        @param command_key: Command name and arguments (functions.command_key).
+        @param result: (exit_code, stdout, stderr, timed_out, partial, extra)
+        """
+        if len(result[1]) + len(result[2]) > self.max_size:
+            return
+
+        if isinstance(result[1], SpooledOutput) or isinstance(result[2], SpooledOutput):
+            # Spooled to keep it out of memory, not copied in to store it
+            return
+
+        name = self._name(key)
+        result = list(result)
+        result[1] = base64.b64encode(str(result[1]))
+        result[2] = base64.b64encode(str(result[2]))
+        data = json.dumps({'key': key, 'command_key': command_key, 'result': result})
+
+        if len(data) > self.max_size:
+            return
+
+        try:
+            filename = os.path.join(self.path, name)
+            tmp_file = filename + '.tmp'
+
+            f = os.fdopen(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), 'w')
+            f.write(data)
+            f.close()
+            os.rename(tmp_file, filename)
+
+        except Exception, e:
+            log.error("Unable to store result %s: %s" % (name, e))
+            return
+
+        self._delete(name, unlink=False)
+        self._files[name] = (time(), len(data))
+        self._size += len(data)
+
+        self._prune()
+
+    def _load(self):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path, 0700)
+
+            for name in os.listdir(self.path):
+                stat = os.stat(os.path.join(self.path, name))
+                self._files[name] = (stat.st_mtime, stat.st_size)
+                self._size += stat.st_size
+
+                if name.endswith('.tmp'):
+                    self._delete(name)
+
+        except OSError, e:
+            log.error("Unable to read result store %s: %s" % (self.path, e))
+
+        self._prune()
+
+    def _prune(self):
+        for name in [name for name in self._files if self._expired(name)]:
+            self._delete(name)
+
+        # Oldest first
+        if len(self._files) > self.max_entries or self._size > self.max_size:
+            for name in sorted(self._files, key=lambda name: self._files[name][0]):
+                if len(self._files) <= self.max_entries and self._size <= self.max_size:
+                    break
+                self._delete(name)
+
+    def _expired(self, name):
+        return self._files[name][0] + self.ttl < time()
+
+    def _delete(self, name, unlink=True):
+        entry = self._files.pop(name, None)
+        if entry:
+            self._size -= entry[1]
+
+        if unlink:
+            try:
+                os.unlink(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _name(key):
+        return sha1(key).hexdigest()
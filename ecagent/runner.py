@@ -16,23 +16,69 @@
 
 _FINAL_OUTPUT_STRING = '[__response__]'
 
+_E_CANCELLED = 250
+_E_INVALID_FRAMES = 249
+
 FLUSH_MIN_LENGTH = 5
 FLUSH_TIME = 5
 
+KILL_GRACE = 10
+
+# Output past this size (bytes, each stream) goes to a file in SPOOL_PATH
+SPOOL_SIZE = 4 * 1024 * 1024
+
+# Optional rlimits by name (RLIMIT_AS, ...), cpu gets SIGXCPU before SIGKILL
+RESOURCE_LIMITS = ['as', 'cpu', 'nofile', 'nproc']
+CPU_LIMIT_GRACE = 5
+
+# Errors telling a limit was hit (looked up at the end of the output)
+LIMIT_ERRORS = {
+    'as': ['MemoryError', 'Cannot allocate memory', 'bad_alloc'],
+    'nofile': ['Too many open files'],
+    'nproc': ['Resource temporarily unavailable'],
+}
+LIMIT_ERRORS_TAIL = 4096
+
+# Optional process priority: nice increment, ionice class[:level], cpus (affinity list)
+PROCESS_PRIORITY = ['nice', 'ionice', 'cpus']
+PRIORITY_TOOLS = {'nice': 'nice', 'ionice': 'ionice', 'cpus': 'taskset'}
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
 # System imports
 import os
 import sys
 import base64
+import errno
+import signal
+from distutils.spawn import find_executable
+from hashlib import sha1
 import simplejson as json
 from time import time
 
 # Twisted imports
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed, maybeDeferred
 from twisted.internet import reactor
+from twisted.internet.utils import getProcessValue
 from twisted.internet.protocol import ProcessProtocol
-from twisted.internet.error import ProcessTerminated, ProcessDone
+from twisted.python.failure import Failure
+from twisted.internet.error import ProcessTerminated, ProcessDone, ProcessExitedAlready
 
 import ecagent.twlogging as log
+from ecagent.buffer import OutputBuffer, SpooledOutput
+from ecagent.cache import ResultCache, CACHE_MAX_ENTRIES, CACHE_MAX_SIZE
+from ecagent.functions import command_key, session_pids
+from ecagent.zygote import Zygote
+from ecagent.manifest import CommandManifest
+from ecagent.flow import FlowControl
+from ecagent.frames import FrameReader, FrameError, encode_frame, PROTOCOL_FRAMES, \
+    FRAME_ARGS, FRAME_OUTPUT, FRAME_DATA, FRAME_RESULT
+from ecagent.rusage import spawn_process
+from ecagent.scheduler import CommandScheduler
+from ecagent.stats import CommandStats
+from ecagent.watcher import PluginWatcher
+
+MANIFEST_FILE = os.path.join(os.path.dirname(__file__), '..', 'cache', 'commands.manifest')
+SPOOL_PATH = os.path.join(os.path.dirname(__file__), '..', 'cache', 'spool')
 
 
 class CommandRunner():
@@ -52,6 +98,43 @@ class CommandRunner():
         self.timeout = int(config['timeout'])
         self.timeout_dc = None
 
+        # Seconds between TERM and KILL on timeout
+        self.kill_grace = KILL_GRACE
+        if 'kill_grace' in config:
+            self.kill_grace = config.as_int('kill_grace')
+
+        self.spool_size = SPOOL_SIZE
+        if 'spool_size' in config:
+            self.spool_size = config.as_int('spool_size')
+
+        # Paused while the XMPP send buffer is full (see SMAgentXMPP)
+        self.flow = FlowControl()
+
+        # Connection stats (ping RTT...) for agent.stats, set by SMAgentXMPP
+        self.xmpp_stats = None
+
+        # Each command runs in its own session so timeouts reach what it forks
+        self._setsid = None
+        if not sys.platform.startswith("win32"):
+            self._setsid = find_executable('setsid')
+
+        # Resource limits: [[limits]] defaults, [[[plugin_xxx.py]]] and [[[command]]] overrides
+        self._limits = config.get('limits', {})
+        self._prlimit = None
+        if self._limits and not sys.platform.startswith("win32"):
+            self._prlimit = find_executable('prlimit')
+            if not self._prlimit:
+                log.warn("prlimit not found, resource limits only apply to zygote commands")
+
+        # CPU and I/O priority: [[process_priority]] defaults, [[[plugin_xxx.py]]] and [[[command]]] overrides
+        self._priority = config.get('process_priority', {})
+        self._priority_tools = {}
+        if self._priority and not sys.platform.startswith("win32"):
+            for name, tool in PRIORITY_TOOLS.items():
+                self._priority_tools[name] = find_executable(tool)
+                if not self._priority_tools[name]:
+                    log.warn("%s not found, %s only applies to zygote commands" % (tool, name))
+
         self.env = os.environ
         self.env['DEBIAN_FRONTEND'] = 'noninteractive'
         self.env['LANG'] = 'en_US.utf8'
@@ -62,61 +145,483 @@ class CommandRunner():
 
         log.debug("ENV: %s" % self.env)
 
+        # Optional fork servers: the zygote for non privileged python plugins and
+        # the privileged helper (a root zygote, one sudo call) for the others
+        self._zygote = None
+        self._helper = None
+        self._use_zygote = 'zygote' in config and config.as_bool('zygote') and not sys.platform.startswith("win32")
+        self._use_helper = 'privileged_helper' in config and config.as_bool('privileged_helper') and \
+            not sys.platform.startswith("win32")
+
+        if self._use_zygote or self._use_helper:
+            reactor.callWhenRunning(self._start_zygotes)
+
+        self.scheduler = CommandScheduler(config)
+        self.stats = CommandStats()
+
+        # Commands run by the agent itself
+        self._builtins = {
+            'agent_stats': self._agent_stats,
+            'agent_cancel': self._agent_cancel
+        }
+
         self._commands = {}
+        self._plugin_commands = {}
+        self._manifest = CommandManifest(config.get('manifest_file', MANIFEST_FILE))
+
+        # Results of read only commands (CACHE_TTL in plugins, [[cache_ttl]] overrides)
+        self._cache = None
+        self._cache_ttl = {}
+        self._plugin_cache_ttl = {}
+        self._plugin_protocols = {}
+
+        # command key -> (IQ id that started it, requests waiting for the same running command)
+        self._in_flight = {}
+        self.coalesced = 0
+        self._config_cache_ttl = dict((command, int(ttl)) for command, ttl in config.get('cache_ttl', {}).items())
+
+        if 'result_cache' not in config or config.as_bool('result_cache'):
+            max_entries = CACHE_MAX_ENTRIES
+            if 'cache_max_entries' in config:
+                max_entries = config.as_int('cache_max_entries')
+
+            max_size = CACHE_MAX_SIZE
+            if 'cache_max_size' in config:
+                max_size = config.as_int('cache_max_size')
+
+            self._cache = ResultCache(max_entries, max_size)
+
+        # IQ id -> scheduler deferred / process, for agent.cancel
+        self._queued = {}
+        self._processes = {}
+
+        # Reload commands when plugins are updated
+        self._watcher = None
+        if 'watch_plugins' not in config or config.as_bool('watch_plugins'):
+            self._watcher = PluginWatcher(self.command_paths, self._plugins_changed)
+
         reactor.callWhenRunning(self._load_commands)
 
+    def _start_zygotes(self):
+        if self._use_zygote:
+            self._zygote = self._start_zygote(self._zygote)
+
+        if self._use_helper:
+            self._helper = self._start_zygote(self._helper, privileged=True)
+
+    def _start_zygote(self, old_zygote, privileged=False):
+        if old_zygote:
+            # Running commands stay with the old one
+            old_zygote.drain()
+
+        zygote = Zygote(self._python_runner, self.command_paths[0], self.env, privileged)
+        zygote.start()
+
+        return zygote
+
     def _load_commands(self):
+        for filename in self._plugin_files():
+            self._index_plugin(filename)
+
+        self._manifest.save()
+
+        if self._watcher:
+            self._watcher.start()
+
+    def _plugin_files(self):
+        plugin_files = []
         for path in self.command_paths:
             log.debug("Processing dir: %s" % path)
             try:
                 if os.path.isdir(path):
                     for filename in os.listdir(path):
-                        if not filename.startswith('plugin_'):
-                            continue
-
-                        if os.path.splitext(filename)[1] not in ['.py','.exe']:
-                            continue
-
-                        log.debug("  Queuing plugin %s for process." % filename)
-                        full_filename = os.path.join(path, filename)
-                        d = self._run_process(full_filename, '', {})
-                        d.addCallback(self._add_command, filename=full_filename)
+                        if self._is_plugin(filename):
+                            plugin_files.append(os.path.join(path, filename))
             except:
                 print sys.exc_info()
 
+        return plugin_files
+
+    @staticmethod
+    def _is_plugin(filename):
+        filename = os.path.basename(filename)
+        return filename.startswith('plugin_') and os.path.splitext(filename)[1] in ['.py', '.exe']
+
+    def _index_plugin(self, filename):
+        commands, self._plugin_cache_ttl[filename], self._plugin_protocols[filename] = \
+            self._manifest.discover(filename)
+
+        if commands is not None:
+            log.debug("  Commands from %s read from source" % os.path.basename(filename))
+            self._set_plugin_commands(filename, commands)
+            return
+
+        log.debug("  Queuing plugin %s for process." % os.path.basename(filename))
+        d = self._run_process(filename, '', {})
+        d.addCallback(self._add_command, filename=filename)
+
     def _add_command(self, data, **kwargs):
-        (exit_code, stdout, stderr, timeout_called) = data
+        (exit_code, stdout, stderr, timeout_called) = data[:4]
 
         if exit_code == 0:
-            for line in stdout.splitlines():
-                self._commands[line.split()[0]] = kwargs['filename']
-                log.debug("Command %s added" % line.split()[0])
+            self._set_plugin_commands(kwargs['filename'], [line.split()[0] for line in stdout.splitlines() if line.strip()])
 
         else:
             log.error('Error adding commands from %s: %s' % (kwargs['filename'], data))
 
         del exit_code, stdout, stderr, timeout_called, data
 
+    def _set_plugin_commands(self, filename, commands):
+        if commands is None:
+            self._plugin_commands.pop(filename, None)
+            self._plugin_cache_ttl.pop(filename, None)
+            self._plugin_protocols.pop(filename, None)
+        else:
+            self._plugin_commands[filename] = commands
+            log.debug("Commands added from %s: %s" % (os.path.basename(filename), ', '.join(commands)))
+
+        if self._cache:
+            self._cache.invalidate(filename)
+
+        # Build a new map and swap it: running commands already have their file
+        command_map = {}
+        cache_ttl = {}
+        for plugin in sorted(self._plugin_commands.keys()):
+            plugin_cache_ttl = self._plugin_cache_ttl.get(plugin, {})
+            for command in self._plugin_commands[plugin]:
+                command_map[command] = plugin
+                if command in plugin_cache_ttl:
+                    cache_ttl[command] = plugin_cache_ttl[command]
+
+        cache_ttl.update(self._config_cache_ttl)
+
+        self._commands = command_map
+        self._cache_ttl = cache_ttl
+
+    def _plugins_changed(self, filenames):
+        reload_all = False
+
+        for filename in filenames:
+            if os.path.basename(filename).startswith('__'):
+                # Support module (__plugin.py, __helper.py...)
+                reload_all = True
+
+            elif not self._is_plugin(filename):
+                continue
+
+            elif os.path.isfile(filename):
+                log.info("Reloading commands from %s" % filename)
+                self._index_plugin(filename)
+
+            else:
+                log.info("Removing commands from %s" % filename)
+                self._set_plugin_commands(filename, None)
+
+        if reload_all:
+            log.info("Plugin support modules changed, reloading all commands")
+            if self._zygote or self._helper:
+                self._start_zygotes()
+
+            for filename in self._plugin_files():
+                self._index_plugin(filename)
+
+        self._manifest.save()
+
     def run_command(self, message, flush_callback=None):
-        if self._commands.get(message.command_name):
+        if message.command_name in self._builtins:
+            return maybeDeferred(self._builtins[message.command_name], message)
+
+        filename = self._commands.get(message.command_name)
+        if filename:
             log.debug("executing %s with args: %s" % (message.command_name, message.command_args))
-            return self._run_process(self._commands[message.command_name], message.command_name, message.command_args, flush_callback, message)
+            command_args = message.command_args
+            key = command_key(message.command_name, command_args)
+
+            # None: not read only, 0: read only but not cached
+            ttl = self._cache and self._cache_ttl.get(message.command_name)
+            if ttl:
+                cached = self._cache.get(key)
+                if cached:
+                    log.info("Result for %s served from cache" % message.command_name)
+                    self.stats.count(message.command_name, 'cached')
+                    return succeed(self._cached_result(cached, message))
+
+            # Same read only command and arguments running: share its result
+            # (delta output can't be shared with requests arriving later)
+            coalesce = getattr(message, 'flush_mode', '') != 'delta' and self._read_only(message.command_name)
+            if coalesce and key in self._in_flight:
+                self.coalesced += 1
+                self.stats.count(message.command_name, 'coalesced')
+                log.info("Attached %s to the same running command (%s coalesced)"
+                         % (message.command_name, self.coalesced))
+
+                d = Deferred()
+                self._in_flight[key][1].append((d, flush_callback, message))
+                return d
+
+            if coalesce:
+                # This request too gets the result like the attached ones,
+                # cancelling it doesn't stop the command for the others
+                requests = [(Deferred(), flush_callback, message)]
+                self._in_flight[key] = (message.id, requests)
+                flush_callback = self._coalesced_flush(requests)
+
+            submitted = time()
+            started = []
+
+            def start():
+                started.append(True)
+                self._queued.pop(message.id, None)
+                self.stats.add(message.command_name, 'queue_wait', time() - submitted)
+                return self._run_process(filename, message.command_name, command_args, flush_callback, message)
+
+            d = self.scheduler.submit(message.command_name, os.path.basename(filename), start)
+            if not started:
+                # Waiting for a slot (agent.cancel takes it out of the queue)
+                self._queued[message.id] = d
+
+            if ttl:
+                d.addCallback(self._cache_result, key, ttl, filename)
+
+            elif self._cache and ttl is None:
+                # Results of this plugin may be stale now
+                d.addBoth(self._invalidate_cache, filename)
+
+            if coalesce:
+                d.addBoth(self._coalesced_result, key, requests)
+                return requests[0][0]
+
+            return d
 
         return
 
+    def sent(self, message):
+        """ Final result of a command sent (compressed by the message) """
+        if message.command_name in self._commands and message.compressed_size is not None:
+            self.stats.add(message.command_name, 'compressed_bytes', message.compressed_size)
+
+    def _agent_stats(self, message):
+        """ agent.stats: latency and size percentiles by command, resource usage by plugin, ping RTT """
+        stats = {
+            'commands': self.stats.summary(),
+            'plugins': self.stats.usage(),
+            'scheduler': self.scheduler.stats(),
+            'cache': self._cache and self._cache.stats() or {},
+            'coalesced': self.coalesced,
+            'flow': self.flow.stats(),
+            'xmpp': self.xmpp_stats and self.xmpp_stats() or {}
+        }
+
+        return 0, json.dumps(stats), '', False, 0, {}
+
+    def _agent_cancel(self, message):
+        """ agent.cancel: stops the command started by the IQ with the given id """
+        request_id = message.command_args.get('id')
+        if self._cancel(request_id):
+            log.info("Command %s cancelled" % request_id)
+            return 0, json.dumps({'cancelled': True}), '', False, 0, {}
+
+        return 1, json.dumps({'cancelled': False}), 'Command %s is not running' % request_id, False, 0, {}
+
+    def _cancel(self, request_id):
+        # Sharing a command: only this request is cancelled, the command
+        # is stopped once nobody waits for it
+        for key, (started_by, requests) in self._in_flight.items():
+            for request in requests:
+                if request[2].id == request_id:
+                    requests.remove(request)
+                    request[0].callback(cancelled_result())
+
+                    if not requests:
+                        del self._in_flight[key]
+                        self._cancel_command(started_by)
+
+                    return True
+
+            if started_by == request_id:
+                # Already cancelled, still running for the others
+                return False
+
+        return self._cancel_command(request_id)
+
+    def _cancel_command(self, request_id):
+        d = self._queued.pop(request_id, None)
+        if d and self.scheduler.cancel(d):
+            d.callback(cancelled_result())
+            return True
+
+        crp = self._processes.get(request_id)
+        if crp:
+            crp.cancel()
+            return True
+
+        return False
+
+    def _read_only(self, command_name):
+        """ Declared in CACHE_TTL (0 when not cached) """
+        return self._cache_ttl.get(command_name) is not None
+
+    def storable(self, command_name):
+        """ Plugin commands that change something (no CACHE_TTL) """
+        return command_name in self._commands and not self._read_only(command_name)
+
+    def in_flight(self, message):
+        """ Would this request be attached to a running one? """
+        return getattr(message, 'flush_mode', '') != 'delta' and \
+            command_key(message.command.replace('.', '_'), message.command_args) in self._in_flight
+
+    @staticmethod
+    def _coalesced_flush(requests):
+        def flush(result, message):
+            for d, flush_callback, request_message in requests:
+                if flush_callback:
+                    flush_callback(result, request_message)
+
+        return flush
+
+    def _coalesced_result(self, result, key, requests):
+        if key in self._in_flight and self._in_flight[key][1] is requests:
+            del self._in_flight[key]
+
+        for d, flush_callback, message in requests:
+            if isinstance(result, Failure):
+                d.errback(result)
+
+            else:
+                d.callback(result)
+
+        # Handed to every request
+        return None
+
+    def _cache_result(self, result, key, ttl, filename):
+        (exit_code, stdout, stderr, timed_out) = result[:4]
+        extra = len(result) > 5 and result[5] or {}
+
+        # Only whole successful outputs (delta results may be a tail) kept in memory
+        if exit_code == 0 and not timed_out and not extra.get('stdout_offset') and not extra.get('stderr_offset') and \
+                not isinstance(stdout, SpooledOutput) and not isinstance(stderr, SpooledOutput):
+            self._cache.set(key, (exit_code, stdout, stderr), ttl, filename)
+
+        return result
+
+    def _invalidate_cache(self, result, filename):
+        self._cache.invalidate(filename)
+        return result
+
+    @staticmethod
+    def _cached_result(cached, message):
+        (exit_code, stdout, stderr) = cached
+        extra = {'cached': 1}
+
+        if getattr(message, 'flush_mode', '') == 'delta':
+            extra.update({
+                'delta': 1,
+                'seq': 1,
+                'stdout_offset': 0,
+                'stderr_offset': 0,
+                'stdout_length': len(stdout),
+                'stderr_length': len(stderr),
+                'stdout_sha1': sha1(stdout).hexdigest(),
+                'stderr_sha1': sha1(stderr).hexdigest()
+            })
+
+        return exit_code, stdout, stderr, False, 0, extra
+
+    def _command_limits(self, filename, command_name):
+        limits = {}
+        for section in [self._limits, self._limits.get(os.path.basename(filename), {}),
+                        self._limits.get(command_name, {})]:
+            for name in RESOURCE_LIMITS:
+                if name in section:
+                    limits[name] = int(section[name])
+
+        for name, value in limits.items():
+            if value <= 0:
+                # Unlimited
+                del limits[name]
+
+            elif name == 'cpu':
+                limits[name] = [value, value + CPU_LIMIT_GRACE]
+
+            else:
+                limits[name] = [value, value]
+
+        return limits
+
+    def _command_priority(self, filename, command_name):
+        priority = {}
+        for section in [self._priority, self._priority.get(os.path.basename(filename), {}),
+                        self._priority.get(command_name, {})]:
+            for name in PROCESS_PRIORITY:
+                if name in section:
+                    priority[name] = section[name]
+
+        try:
+            if 'nice' in priority:
+                priority['nice'] = int(priority['nice'])
+
+            if 'ionice' in priority:
+                io_class, level = (str(priority['ionice']).split(':') + [''])[:2]
+                priority['ionice'] = [IONICE_CLASSES[io_class], level and int(level) or None]
+
+            if 'cpus' in priority:
+                # configobj splits "0,2-3" in a list
+                cpus = priority['cpus']
+                if isinstance(cpus, list):
+                    cpus = ','.join(cpus)
+
+                if not cpus or cpus.strip('0123456789,-'):
+                    raise ValueError(cpus)
+
+                priority['cpus'] = cpus
+
+        except (KeyError, ValueError):
+            log.warn("Invalid process priority for %s: %s" % (command_name, priority))
+            return {}
+
+        return priority
+
+    def _priority_args(self, priority):
+        """ taskset, ionice and nice wrapping a command """
+        args = []
+        if 'cpus' in priority and self._priority_tools.get('cpus'):
+            args += [self._priority_tools['cpus'], '-c', priority['cpus']]
+
+        if 'ionice' in priority and self._priority_tools.get('ionice'):
+            io_class, level = priority['ionice']
+            args += [self._priority_tools['ionice'], '-c', str(io_class)]
+            if level is not None:
+                args += ['-n', str(level)]
+
+        if 'nice' in priority and self._priority_tools.get('nice'):
+            args += [self._priority_tools['nice'], '-n', str(priority['nice'])]
+
+        return args
+
     def _run_process(self, filename, command_name, command_args, flush_callback=None, message=None):
         need_sudo = ['plugin_pip.py', 'plugin_service.py', 'plugin_update.py', 'plugin_haproxy.py', 'plugin_monitor.py', 'plugin_pip_extra.py', 'plugin_puppet.py', 'plugin_saltstack.py', 'plugin_proc.py']
         ext = os.path.splitext(filename)[1]
+        zygote = None
+
+        # Frames protocol when the plugin speaks it (not for listing commands)
+        framed = bool(command_name) and PROTOCOL_FRAMES in self._plugin_protocols.get(filename, [])
+        protocol = framed and [PROTOCOL_FRAMES] or []
+
         if ext == '.py':
             from sys import platform
             if platform.startswith("win32") or os.path.split(filename)[1] not in need_sudo:
                 command = self._python_runner
-                args = [command, '-u', '-W ignore::DeprecationWarning', filename, command_name]
+                args = [command, '-u', '-W ignore::DeprecationWarning', filename, command_name] + protocol
+                if self._zygote and self._zygote.ready:
+                    zygote = self._zygote
 
             else:
+                if self._helper and self._helper.ready:
+                    zygote = self._helper
+
                 command = 'sudo'
                 # -u: sets unbuffered output
-                args = [command, self._python_runner, '-u', '-W ignore::DeprecationWarning', filename, command_name]
+                args = [command, self._python_runner, '-u', '-W ignore::DeprecationWarning', filename, command_name] + protocol
 
         else:
             command = filename
@@ -131,9 +636,43 @@ class CommandRunner():
         else:
             log.info("[INIT] Loading commands from %s" % filename)
 
-        crp = CommandRunnerProcess(cmd_timeout, command_args, flush_callback, message)
+        crp = CommandRunnerProcess(cmd_timeout, command_args, flush_callback, message, self.kill_grace, framed,
+                                   self.spool_size, self.flow)
         d = crp.getDeferredResult()
-        reactor.spawnProcess(crp, command, args, env=self.env)
+
+        limits = self._limits and self._command_limits(filename, command_name)
+        priority = self._priority and self._command_priority(filename, command_name)
+
+        if command_name:
+            d.addCallback(self._record_process, filename, command_name, crp)
+
+        if message:
+            self._processes[message.id] = crp
+            d.addBoth(self._process_finished, message.id)
+
+        if zygote:
+            # Zygote children call setsid and setrlimit
+            crp.session = True
+            crp.limits = limits
+            zygote.spawn(crp, filename, command_name, limits, protocol, priority)
+
+        else:
+            if priority:
+                args = self._priority_args(priority) + args
+                command = args[0]
+
+            if limits and self._prlimit:
+                crp.limits = limits
+                command = self._prlimit
+                args = [command] + ['--%s=%d:%d' % (name, soft, hard) for name, (soft, hard) in sorted(limits.items())] + \
+                       ['--'] + args
+
+            if self._setsid:
+                crp.session = True
+                command = self._setsid
+                args = [command] + args
+
+            spawn_process(crp, command, args, self.env)
 
         del cmd_timeout, filename, command_name, command_args
         del flush_callback, message, args
@@ -141,14 +680,68 @@ class CommandRunner():
         return d
 
 
+    def _process_finished(self, result, request_id):
+        self._processes.pop(request_id, None)
+        return result
+
+    def _record_process(self, result, filename, command_name, crp):
+        if crp.first_byte:
+            self.stats.add(command_name, 'first_byte', crp.first_byte - crp.spawned)
+
+        self.stats.add(command_name, 'run_time', crp.finished - crp.spawned)
+        self.stats.add(command_name, 'output_bytes', crp.output_size)
+
+        if crp.rusage:
+            self.stats.add_usage(os.path.basename(filename), crp.rusage, crp.maxrss_base)
+
+        return result
+
+
+def cancelled_result():
+    return _E_CANCELLED, '', 'Cancelled', False, 0, {'cancelled': 1}
+
+
 class CommandRunnerProcess(ProcessProtocol):
-    def __init__(self, timeout, command_args, flush_callback=None, message=None):
-        self.stdout = ""
-        self.stderr = ""
+    def __init__(self, timeout, command_args, flush_callback=None, message=None, kill_grace=KILL_GRACE, framed=False,
+                 spool_size=0, flow=None):
+        # Delta flush: partial results only carry new output
+        self.delta = getattr(message, 'flush_mode', '') == 'delta'
+        self.flush_seq = 0
+        self.sent_stdout = 0
+        self.sent_stderr = 0
+
+        self.stdout = OutputBuffer(checksum=self.delta, spool_size=spool_size, spool_path=SPOOL_PATH)
+        self.stderr = OutputBuffer(checksum=self.delta, spool_size=spool_size, spool_path=SPOOL_PATH)
+        self.flow = flow
         self.deferreds = []
         self.timeout = timeout
         self.command_args = command_args
 
+        # Process is a session leader (its pid is the session id)
+        self.session = False
+        self.kill_grace = kill_grace
+        self.kill_dc = None
+        self.killed = 0
+        self.ended = False
+        self.cancelled = False
+        self.timeout_dc = None
+
+        # Resource limits set for the process
+        self.limits = {}
+
+        # Timings and size for CommandRunner.stats
+        self.spawned = time()
+        self.first_byte = None
+        self.finished = None
+        self.output_size = 0
+        self.rusage = None
+        self.maxrss_base = None
+
+        # Frames protocol (see ecagent/frames.py)
+        self.framed = framed
+        self.frames = framed and FrameReader() or None
+        self.frame_error = None
+
         self.last_send_data_size = 0
         self.last_send_data_time = time()
         self.flush_callback = flush_callback
@@ -164,35 +757,169 @@ class CommandRunnerProcess(ProcessProtocol):
     def connectionMade(self):
         log.debug("Process started.")
         self.pid = self.transport.pid
-        self.timeout_dc = reactor.callLater(self.timeout, self.transport.signalProcess, 'KILL')
+        if self.cancelled:
+            # Cancelled before it started
+            self._terminate()
+            return
+
+        if self.flow:
+            self.flow.add(self.transport)
+
+        self.timeout_dc = reactor.callLater(self.timeout, self._timeout)
 
         # Pass the call arguments via stdin in json format
-        self.transport.write(base64.b64encode(json.dumps(self.command_args)))
+        if self.framed:
+            self.transport.write(encode_frame(FRAME_ARGS, json.dumps(self.command_args)))
+
+        else:
+            self.transport.write(base64.b64encode(json.dumps(self.command_args)))
 
         # And close stdin to signal we are done writing args.
         self.transport.closeStdin()
 
+    def _timeout(self):
+        log.info("Timeout: terminating process %s" % self.pid)
+        self._terminate()
+
+    def cancel(self):
+        """
+        Terminates the process tree, the result (marked as cancelled)
+        is returned now with the output so far.
+        """
+        if self.ended or self.cancelled:
+            return
+
+        self.cancelled = True
+        self.finished = time()
+        self.flush_callback = None
+        self._cancel_flush(self.flush_later)
+        self._cancel_flush(self.flush_later_forced)
+
+        if self.timeout_dc:
+            if self.timeout_dc.active():
+                self.timeout_dc.cancel()
+
+            # Timed out already: terminated, KILL after kill_grace on its way
+            if not (self.kill_dc and self.kill_dc.active()):
+                self._terminate()
+
+        self.output_size = len(self.stdout) + len(self.stderr)
+        stdout, stderr, extra = self._output()
+        extra['cancelled'] = 1
+        extra['killed'] = self.killed
+
+        deferreds, self.deferreds = self.deferreds, []
+        for d in deferreds:
+            d.callback((_E_CANCELLED, stdout, stderr, False, 0, extra))
+
+    def _terminate(self):
+        """ TERM to the process and its descendants, KILL after kill_grace """
+        pids = self._tree()
+        self.killed = len([pid for pid in pids if pid != self.pid])
+
+        log.info("Terminating process %s and %s descendants" % (self.pid, self.killed))
+        self._signal_tree('TERM', pids)
+        self.kill_dc = reactor.callLater(self.kill_grace, self._kill)
+
+    def _kill(self):
+        pids = self._tree()
+        if pids or not self.ended:
+            log.info("Timeout: killing process %s and %s descendants" % (self.pid, len(pids)))
+            self._signal_tree('KILL', pids)
+
+    def _tree(self):
+        if self.session:
+            return session_pids(self.pid)
+
+        return []
+
+    def _signal_tree(self, signal_name, pids):
+        if not self.ended:
+            try:
+                self.transport.signalProcess(signal_name)
+
+            except (ProcessExitedAlready, OSError):
+                pass
+
+        denied = []
+        for pid in pids:
+            if pid == self.pid:
+                continue
+
+            try:
+                os.kill(pid, getattr(signal, 'SIG' + signal_name))
+
+            except OSError, e:
+                if e.errno == errno.EPERM:
+                    denied.append(str(pid))
+
+        if denied:
+            # Started by sudo
+            getProcessValue('sudo', ['-n', 'kill', '-' + signal_name] + denied, env=os.environ)
+
     def outReceived(self, data):
         log.debug("Out made: %s" % data)
 
-        if _FINAL_OUTPUT_STRING in data:
+        if not self.first_byte:
+            self.first_byte = time()
+
+        if self.framed:
+            self._frames_received(data)
+
+        elif _FINAL_OUTPUT_STRING in data:
             for line in data.split("\n"):
                 if _FINAL_OUTPUT_STRING in line:
                     # Skip this line and stop flush callback
-                    self.stdout = self.stderr = ''
-                    self.flush_callback = None
+                    self._final_output()
 
                 else:
-                    self.stdout += line
+                    self.stdout.write(line)
         else:
-            self.stdout += data
+            self.stdout.write(data)
 
         del data
         self._flush()
 
+    def _frames_received(self, data):
+        if self.frame_error:
+            return
+
+        try:
+            frames = self.frames.feed(data)
+
+        except FrameError, e:
+            # Something wrote to stdout behind the plugin's back: the
+            # result frame can't be found anymore, the command fails
+            log.warn("Invalid frames from process %s: %s" % (self.pid, e))
+            self.frame_error = str(e)
+            self.flush_callback = None
+            frames = e.frames
+
+        for frame_type, payload in frames:
+            if frame_type == FRAME_OUTPUT:
+                self.stdout.write(payload)
+
+            elif frame_type == FRAME_DATA:
+                if self.flush_callback:
+                    self.flush_callback((None, payload, '', 0, 0, {'data': 1}), self.message)
+
+            elif frame_type == FRAME_RESULT:
+                self._final_output()
+                self.stdout.write(payload)
+
+    def _final_output(self):
+        # Result replaces the output and stops flush callback
+        self.stdout.reset()
+        self.stderr.reset()
+        self.sent_stdout = self.sent_stderr = 0
+        self.flush_callback = None
+
     def errReceived(self, data):
         log.debug("Err made: %s" % data)
-        self.stderr += data
+
+        if not self.first_byte:
+            self.first_byte = time()
+        self.stderr.write(data)
         del data
         self._flush()
 
@@ -208,20 +935,52 @@ class CommandRunnerProcess(ProcessProtocol):
                 self.last_send_data_size = total_out
                 self.last_send_data_time = curr_time
 
-                log.debug("Scheduling a flush response: %s" % self.stdout)
+                log.debug("Scheduling a flush response")
                 self._cancel_flush(self.flush_later_forced)
-                self.flush_later = reactor.callLater(1, self.flush_callback,
-                                                     (None, self.stdout, self.stderr, 0, total_out), self.message)
+                self.flush_later = reactor.callLater(1, self._send_flush)
 
         if not self.flush_later:
             self._cancel_flush(self.flush_later_forced)
-            self.flush_later_forced = reactor.callLater(FLUSH_TIME, self.flush_callback,
-                                                        (None, self.stdout, self.stderr, 0, total_out), self.message)
+            self.flush_later_forced = reactor.callLater(FLUSH_TIME, self._send_flush)
 
         del total_out
 
+    def _send_flush(self):
+        # Output is read when the flush is sent, not copied when scheduled
+        if self.flush_callback:
+            total_out = len(self.stdout) + len(self.stderr)
+
+            if self.delta:
+                stdout, stderr, extra = self._delta()
+                self.flush_callback((None, stdout, stderr, 0, total_out, extra), self.message)
+
+            else:
+                self.flush_callback((None, self.stdout.getvalue(), self.stderr.getvalue(), 0, total_out), self.message)
+
+    def _delta(self):
+        """
+        Output since the last flush. Offsets tell where the data goes in the
+        whole output (0 means start over, i.e. the final response).
+        """
+        self.flush_seq += 1
+        extra = {
+            'delta': 1,
+            'seq': self.flush_seq,
+            'stdout_offset': self.sent_stdout,
+            'stderr_offset': self.sent_stderr
+        }
+
+        stdout = self.stdout.since(self.sent_stdout)
+        stderr = self.stderr.since(self.sent_stderr)
+        self.sent_stdout = len(self.stdout)
+        self.sent_stderr = len(self.stderr)
+
+        return stdout, stderr, extra
+
     def processEnded(self, status):
         log.debug("Process ended")
+        self.ended = True
+        self.finished = time()
         self.flush_callback = None
 
         # Cancel flush callbacks
@@ -231,21 +990,102 @@ class CommandRunnerProcess(ProcessProtocol):
 
         # Get command retval
         t = type(status.value)
+        exit_signal = None
         if t is ProcessDone:
             exit_code = 0
 
         elif t is ProcessTerminated:
             exit_code = status.value.exitCode
+            exit_signal = status.value.signal
 
         else:
             raise status
 
-        if not self.timeout_dc.called:
+        # wait4() data of the process and its descendants
+        self.rusage = getattr(self.transport, 'rusage', None)
+        self.maxrss_base = getattr(self.transport, 'maxrss_base', None)
+
+        if self.flow:
+            self.flow.remove(self.transport)
+
+        if self.timeout_dc and self.timeout_dc.active():
             self.timeout_dc.cancel()
 
+        if self.kill_dc and self.kill_dc.active() and not self._tree():
+            self.kill_dc.cancel()
+
+        if self.cancelled:
+            # Result already sent
+            self.stdout.reset()
+            self.stderr.reset()
+            return
+
+        if self.frame_error:
+            exit_code = _E_INVALID_FRAMES
+            self.stderr.write("Invalid output from plugin: %s\n" % self.frame_error)
+
+        limits_hit = self.limits and self._limits_hit(exit_code, exit_signal)
+        self.output_size = len(self.stdout) + len(self.stderr)
+
+        stdout, stderr, extra = self._output()
+
+        if self.timeout_dc.called:
+            # Descendants terminated with it
+            extra['killed'] = self.killed
+
+        if limits_hit:
+            log.warn("Process %s hit resource limits: %s" % (self.pid, ', '.join(limits_hit)))
+            extra['limit'] = ','.join(limits_hit)
+
+        if self.rusage:
+            for field, value in self.rusage.items():
+                extra['ru_' + field] = value
+
+            if self.maxrss_base:
+                extra['ru_maxrss_base'] = self.maxrss_base
+
+        self.stdout.reset()
+        self.stderr.reset()
+
         for d in self.deferreds:
-            d.callback((exit_code, self.stdout, self.stderr,
-                        self.timeout_dc.called))
+            d.callback((exit_code, stdout, stderr,
+                        self.timeout_dc.called, 0, extra))
+
+    def _output(self):
+        if self.delta:
+            # Tail and checksums of the whole output
+            stdout, stderr, extra = self._delta()
+            extra['stdout_length'] = len(self.stdout)
+            extra['stderr_length'] = len(self.stderr)
+            extra['stdout_sha1'] = self.stdout.sha1()
+            extra['stderr_sha1'] = self.stderr.sha1()
+
+        else:
+            stdout = self.stdout.getvalue()
+            stderr = self.stderr.getvalue()
+            extra = {}
+
+        return stdout, stderr, extra
+
+    def _limits_hit(self, exit_code, exit_signal):
+        if exit_code == 0:
+            return []
+
+        hit = []
+        if 'cpu' in self.limits and exit_signal in (signal.SIGXCPU, signal.SIGKILL) and not self.timeout_dc.called:
+            hit.append('cpu')
+
+        tail = self.stdout.since(len(self.stdout) - LIMIT_ERRORS_TAIL) + \
+               self.stderr.since(len(self.stderr) - LIMIT_ERRORS_TAIL)
+
+        for name in RESOURCE_LIMITS:
+            if name in self.limits and name in LIMIT_ERRORS:
+                for error in LIMIT_ERRORS[name]:
+                    if error in tail:
+                        hit.append(name)
+                        break
+
+        return hit
 
     def getDeferredResult(self):
         d = Deferred()
@@ -0,0 +1,113 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Resource usage of finished commands, as returned by wait4(): the command
+process and every descendant it waited for.
+
+maxrss is never below the memory the command was forked with from the
+agent or the zygote (its anonymous RSS): Linux keeps the high-water mark
+across exec. That RSS is reported as maxrss_base, a maxrss close to it
+tells nothing about the command.
+"""
+
+# Same order in the zygote exit lines (plugins/__zygote.py)
+RUSAGE_FIELDS = ['utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw', 'nivcsw']
+
+# Seconds, the others are counters (maxrss in KB)
+RUSAGE_TIME_FIELDS = ['utime', 'stime']
+
+# Totals by plugin keep the largest value of these
+RUSAGE_MAX_FIELDS = ['maxrss']
+
+# System imports
+import os
+import mmap
+import errno
+
+# Twisted imports
+from twisted.internet import reactor
+from twisted.python import log as twisted_log
+from twisted.python.runtime import platformType
+
+
+def rusage_dict(values):
+    """ RUSAGE_FIELDS from a resource.struct_rusage or a list of values in that order """
+    if not isinstance(values, list):
+        values = [getattr(values, 'ru_' + field) for field in RUSAGE_FIELDS]
+
+    rusage = {}
+    for field, value in zip(RUSAGE_FIELDS, values):
+        if field in RUSAGE_TIME_FIELDS:
+            rusage[field] = round(float(value), 4)
+        else:
+            rusage[field] = int(float(value))
+
+    return rusage
+
+
+def forked_rss():
+    """ Anonymous RSS (KB) a child forked now starts with, None if unknown (Linux /proc) """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            resident, shared = f.read().split()[1:3]
+            return (int(resident) - int(shared)) * mmap.PAGESIZE / 1024
+
+        finally:
+            f.close()
+
+    except (IOError, ValueError):
+        return None
+
+
+def spawn_process(process_protocol, command, args, env):
+    """
+    reactor.spawnProcess, the transport gets a rusage attribute once
+    reaped and maxrss_base
+    """
+    if platformType != 'posix':
+        return reactor.spawnProcess(process_protocol, command, args, env=env)
+
+    maxrss_base = forked_rss()
+    process = RusageProcess(reactor, command, args, env, None, process_protocol)
+    process.maxrss_base = maxrss_base
+
+    return process
+
+
+if platformType == 'posix':
+    from twisted.internet.process import Process, unregisterReapProcessHandler
+
+    class RusageProcess(Process):
+        rusage = None
+        maxrss_base = None
+
+        def reapProcess(self):
+            """ Same as Process.reapProcess with wait4() instead of waitpid() """
+            try:
+                pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    twisted_log.msg('Failed to reap %d:' % self.pid)
+                    twisted_log.err()
+                pid = None
+
+            if pid:
+                self.rusage = rusage_dict(rusage)
+                self.processEnded(status)
+                unregisterReapProcessHandler(pid, self)
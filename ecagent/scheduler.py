@@ -0,0 +1,208 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+PRIORITIES = ['high', 'normal', 'low']
+
+MAX_RUNNING = 8
+HIGH_PRIORITY_RESERVE = 2
+
+# Used when [Plugins] has no [[priorities]] / [[plugin_limits]]
+DEFAULT_PRIORITIES = {
+    'agent_ping': 'high',
+    'monitor_get': 'high',
+    'update_system': 'low',
+    'update_check': 'low',
+    'pip_install': 'low',
+    'pip_outdated_packages': 'low',
+}
+
+DEFAULT_PLUGIN_LIMITS = {
+    'plugin_update.py': 1,
+    'plugin_pip.py': 1,
+}
+
+# System imports
+import heapq
+from time import time
+
+# Twisted imports
+from twisted.internet.defer import Deferred, maybeDeferred
+
+import ecagent.twlogging as log
+
+
+class CommandScheduler:
+    def __init__(self, config):
+        """
+        Admission control for plugin commands: a global limit of running
+        commands, per plugin limits and priority classes.
+        High priority commands can use HIGH_PRIORITY_RESERVE slots that
+        normal and low ones can't, so they never wait behind a burst of
+        package upgrades.
+
+        @param config: [Plugins] section (max_running, high_priority_reserve,
+        [[priorities]] command = high|normal|low, [[plugin_limits]] file = N)
+        """
+        self.max_running = MAX_RUNNING
+        if 'max_running' in config:
+            self.max_running = config.as_int('max_running')
+
+        self.high_priority_reserve = HIGH_PRIORITY_RESERVE
+        if 'high_priority_reserve' in config:
+            self.high_priority_reserve = config.as_int('high_priority_reserve')
+
+        self.priorities = dict(config.get('priorities', DEFAULT_PRIORITIES))
+        self.plugin_limits = dict((plugin, int(limit)) for plugin, limit in
+                                  config.get('plugin_limits', DEFAULT_PLUGIN_LIMITS).items())
+
+        self._queue = []
+        self._dispatching = False
+        self._redispatch = False
+        self._seq = 0
+        self._running = 0
+        self._running_plugins = {}
+
+        # priority -> [count, total wait, max wait]
+        self._waits = dict((priority, [0, 0.0, 0.0]) for priority in PRIORITIES)
+
+    def priority(self, command_name):
+        priority = self.priorities.get(command_name, 'normal')
+        if priority not in PRIORITIES:
+            priority = 'normal'
+
+        return priority
+
+    def submit(self, command_name, plugin, start):
+        """
+        Queues a command, start() is called (and must return a Deferred)
+        when there is room for it. Returns a Deferred with its result.
+        """
+        priority = self.priority(command_name)
+
+        self._seq += 1
+        job = {
+            'command': command_name,
+            'plugin': plugin,
+            'priority': priority,
+            'start': start,
+            'queued': time(),
+            'deferred': Deferred(),
+        }
+
+        heapq.heappush(self._queue, (PRIORITIES.index(priority), self._seq, job))
+        self._dispatch()
+
+        return job['deferred']
+
+    def cancel(self, deferred):
+        """ Removes a queued command, False if it's not queued """
+        for item in self._queue:
+            if item[2]['deferred'] is deferred:
+                self._queue.remove(item)
+                heapq.heapify(self._queue)
+                return True
+
+        return False
+
+    def stats(self):
+        queued = dict((priority, 0) for priority in PRIORITIES)
+        for item in self._queue:
+            queued[item[2]['priority']] += 1
+
+        waits = {}
+        for priority, (count, total, max_wait) in self._waits.items():
+            waits[priority] = {
+                'count': count,
+                'avg': count and round(total / count, 3) or 0,
+                'max': round(max_wait, 3)
+            }
+
+        return {
+            'running': self._running,
+            'running_plugins': dict(self._running_plugins),
+            'queued': len(self._queue),
+            'queued_priority': queued,
+            'wait': waits
+        }
+
+    def _can_start(self, job):
+        limit = self.max_running
+        if job['priority'] != 'high':
+            limit = max(1, limit - self.high_priority_reserve)
+
+        if self._running >= limit:
+            return False
+
+        plugin_limit = self.plugin_limits.get(job['plugin'])
+        if plugin_limit and self._running_plugins.get(job['plugin'], 0) >= plugin_limit:
+            return False
+
+        return True
+
+    def _dispatch(self):
+        if self._dispatching:
+            # A command finished while starting another one
+            self._redispatch = True
+            return
+
+        self._dispatching = True
+        try:
+            self._redispatch = True
+            while self._redispatch:
+                self._redispatch = False
+
+                waiting = []
+                while self._queue:
+                    item = heapq.heappop(self._queue)
+                    if self._can_start(item[2]):
+                        self._start(item[2])
+                    else:
+                        waiting.append(item)
+
+                for item in waiting:
+                    heapq.heappush(self._queue, item)
+
+        finally:
+            self._dispatching = False
+
+    def _start(self, job):
+        wait = time() - job['queued']
+        stats = self._waits[job['priority']]
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] = max(stats[2], wait)
+
+        self._running += 1
+        self._running_plugins[job['plugin']] = self._running_plugins.get(job['plugin'], 0) + 1
+
+        log.debug("Starting %s (%s priority) after %.3fs queued, running: %s, queued: %s"
+                  % (job['command'], job['priority'], wait, self._running, len(self._queue)))
+
+        d = maybeDeferred(job['start'])
+        d.addBoth(self._finished, job)
+        d.chainDeferred(job['deferred'])
+
+        del job['start']
+
+    def _finished(self, result, job):
+        self._running -= 1
+        self._running_plugins[job['plugin']] -= 1
+        if not self._running_plugins[job['plugin']]:
+            del self._running_plugins[job['plugin']]
+
+        self._dispatch()
+
+        return result
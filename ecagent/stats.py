@@ -0,0 +1,141 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+HISTOGRAM_BUCKETS = 96
+HISTOGRAM_GROWTH = 1.25
+
+PERCENTILES = [50, 95, 99]
+
+# Smallest value told apart by each metric (seconds or bytes)
+METRICS = {
+    'queue_wait': 0.0001,
+    'first_byte': 0.0001,
+    'run_time': 0.0001,
+    'output_bytes': 1,
+    'compressed_bytes': 1,
+}
+
+# System imports
+from math import log
+
+from ecagent.rusage import RUSAGE_MAX_FIELDS, RUSAGE_TIME_FIELDS
+
+
+class Histogram:
+    def __init__(self, minimum, buckets=HISTOGRAM_BUCKETS, growth=HISTOGRAM_GROWTH):
+        """
+        Fixed memory histogram: bucket i counts values up to
+        minimum * growth ** i (the last one counts everything above).
+        Percentiles are accurate to the bucket width (growth).
+        """
+        self.minimum = minimum
+        self.growth = growth
+        self.buckets = [0] * buckets
+
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        if value <= self.minimum:
+            index = 0
+        else:
+            index = min(int(log(float(value) / self.minimum, self.growth)) + 1, len(self.buckets) - 1)
+
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0
+
+        rank = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(self.minimum * self.growth ** index, self.max)
+
+        return self.max
+
+    def summary(self):
+        summary = {
+            'count': self.count,
+            'avg': self.count and round(float(self.total) / self.count, 4) or 0,
+            'max': round(self.max, 4)
+        }
+
+        for percent in PERCENTILES:
+            summary['p%d' % percent] = round(self.percentile(percent), 4)
+
+        return summary
+
+
+class CommandStats:
+    def __init__(self):
+        """
+        Histograms (METRICS) and counters by command name,
+        resource usage totals by plugin.
+        """
+        self._commands = {}
+        self._plugins = {}
+
+    def add(self, command_name, metric, value):
+        histograms = self._command(command_name)['metrics']
+        if metric not in histograms:
+            histograms[metric] = Histogram(METRICS[metric])
+
+        histograms[metric].add(value)
+
+    def count(self, command_name, counter):
+        counters = self._command(command_name)['counters']
+        counters[counter] = counters.get(counter, 0) + 1
+
+    def summary(self):
+        summary = {}
+        for command_name, command in self._commands.items():
+            summary[command_name] = dict(command['counters'])
+            for metric, histogram in command['metrics'].items():
+                summary[command_name][metric] = histogram.summary()
+
+        return summary
+
+    def add_usage(self, plugin, rusage, maxrss_base=None):
+        """ maxrss_base: RSS the command was forked with, its own peak is only known above it """
+        totals = self._plugins.setdefault(plugin, {'commands': 0})
+        totals['commands'] += 1
+
+        for field, value in rusage.items():
+            if field in RUSAGE_MAX_FIELDS:
+                if value > (maxrss_base or 0):
+                    totals[field] = max(totals.get(field, 0), value)
+
+            elif field in RUSAGE_TIME_FIELDS:
+                totals[field] = round(totals.get(field, 0) + value, 4)
+
+            else:
+                totals[field] = totals.get(field, 0) + value
+
+    def usage(self):
+        return dict((plugin, dict(totals)) for plugin, totals in self._plugins.items())
+
+    def _command(self, command_name):
+        if command_name not in self._commands:
+            self._commands[command_name] = {'metrics': {}, 'counters': {}}
+
+        return self._commands[command_name]
@@ -0,0 +1,231 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+XMPP stream management (XEP-0198): stanzas acknowledged by the server
+and session resumption.
+
+Sent stanzas are kept until the server acks them. When the connection
+drops the next stream resumes the session (no resource binding nor
+presence) and sends the unacked ones again; if it can't be resumed they
+are sent again in the new session.
+"""
+
+NS_SM = 'urn:xmpp:sm:3'
+
+# Seconds after sending a stanza before asking the server for an ack
+SM_ACK_DELAY = 1
+
+# Stanza counters wrap at 2^32
+SM_COUNTER = 2 ** 32
+
+SM_STANZAS = ('iq', 'message', 'presence')
+
+# System imports
+from collections import deque
+
+# Twisted imports
+from twisted.internet import defer, reactor
+from twisted.words.protocols.jabber import xmlstream
+from twisted.words.xish.domish import Element
+
+import ecagent.twlogging as log
+
+
+class StreamManagement:
+    def __init__(self, wanted=True):
+        """
+        Stream management state kept between connections.
+
+        @param wanted: Enable it if the server offers it.
+        """
+        self.wanted = wanted
+        self.id = None
+        self.enabled = False
+        self.resumed = False
+
+        # Stanzas received / sent and acked by the server
+        self.inbound = 0
+        self.acked = 0
+
+        # Serialized stanzas sent and not acked yet
+        self._unacked = deque()
+        self._xs = None
+        self._ack_request = None
+
+    def send(self, xs, data):
+        """ Writes a serialized stanza to the stream """
+        if self.enabled:
+            self._unacked.append(data)
+            self._schedule_ack()
+
+        xs.send(data)
+
+    def start(self, xs):
+        """ Stream authenticated: stanzas not acked on the previous one are sent again """
+        self._xs = xs
+        if self.enabled:
+            xs.addObserver('/*', self._received)
+
+        pending = list(self._unacked)
+        if not self.resumed:
+            # Counted again in this session
+            self._unacked.clear()
+
+        if pending:
+            log.info("Sending again %d stanzas not acknowledged by the server" % len(pending))
+
+        for data in pending:
+            if self.resumed:
+                xs.send(data)
+            else:
+                self.send(xs, data)
+
+        if self.resumed and pending:
+            self._schedule_ack()
+
+    def stop(self):
+        """ Stream end: state kept to resume it """
+        self._xs = None
+        self.enabled = False
+        self.resumed = False
+
+        if self._ack_request and self._ack_request.active():
+            self._ack_request.cancel()
+        self._ack_request = None
+
+    def enable(self, sm_id):
+        """ New session, sm_id if it can be resumed """
+        self.id = sm_id
+        self.enabled = True
+        self.inbound = 0
+        self.acked = 0
+
+    def resume(self, h):
+        self.enabled = True
+        self.resumed = True
+        self._ack(h)
+
+    def reset(self):
+        """ The session can't be resumed """
+        self.id = None
+        self.inbound = 0
+        self.acked = 0
+
+    def _received(self, element):
+        if element.name in SM_STANZAS:
+            self.inbound = (self.inbound + 1) % SM_COUNTER
+
+        elif element.uri == NS_SM and element.name == 'r':
+            answer = Element((NS_SM, 'a'))
+            answer['h'] = str(self.inbound)
+            self._xs.send(answer)
+
+        elif element.uri == NS_SM and element.name == 'a':
+            self._ack(int(element['h']))
+
+    def _ack(self, h):
+        handled = (h - self.acked) % SM_COUNTER
+        for i in range(min(handled, len(self._unacked))):
+            self._unacked.popleft()
+
+        self.acked = h
+
+    def _schedule_ack(self):
+        if not self._ack_request or not self._ack_request.active():
+            self._ack_request = reactor.callLater(SM_ACK_DELAY, self._request_ack)
+
+    def _request_ack(self):
+        if self._xs and self.enabled and self._unacked:
+            self._xs.send(Element((NS_SM, 'r')))
+
+
+class ResumeInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    feature = (NS_SM, 'sm')
+    _deferred = None
+
+    def __init__(self, xs, stream_management):
+        xmlstream.BaseFeatureInitiatingInitializer.__init__(self, xs)
+        self.stream_management = stream_management
+
+    def start(self):
+        if not self.stream_management.wanted or not self.stream_management.id:
+            return None
+
+        self._deferred = defer.Deferred()
+        self.xmlstream.addOnetimeObserver('/resumed', self.onResumed)
+        self.xmlstream.addOnetimeObserver('/failed', self.onFailed)
+
+        resume = Element((NS_SM, 'resume'))
+        resume['previd'] = self.stream_management.id
+        resume['h'] = str(self.stream_management.inbound)
+        self.xmlstream.send(resume)
+
+        return self._deferred
+
+    def onResumed(self, element):
+        self.xmlstream.removeObserver('/failed', self.onFailed)
+        self.stream_management.resume(int(element['h']))
+        log.info("XMPP session resumed")
+
+        # Already bound, with session and presence
+        del self.xmlstream.initializers[1:]
+        self._deferred.callback(None)
+
+    def onFailed(self, element):
+        self.xmlstream.removeObserver('/resumed', self.onResumed)
+        self.stream_management.reset()
+        log.info("Unable to resume the XMPP session, starting a new one")
+        self._deferred.callback(None)
+
+
+class EnableInitializer(xmlstream.BaseFeatureInitiatingInitializer):
+    feature = (NS_SM, 'sm')
+    _deferred = None
+
+    def __init__(self, xs, stream_management):
+        xmlstream.BaseFeatureInitiatingInitializer.__init__(self, xs)
+        self.stream_management = stream_management
+
+    def start(self):
+        if not self.stream_management.wanted:
+            return None
+
+        self._deferred = defer.Deferred()
+        self.xmlstream.addOnetimeObserver('/enabled', self.onEnabled)
+        self.xmlstream.addOnetimeObserver('/failed', self.onFailed)
+
+        enable = Element((NS_SM, 'enable'))
+        enable['resume'] = 'true'
+        self.xmlstream.send(enable)
+
+        return self._deferred
+
+    def onEnabled(self, element):
+        self.xmlstream.removeObserver('/failed', self.onFailed)
+
+        sm_id = None
+        if element.getAttribute('resume') in ('true', '1'):
+            sm_id = element.getAttribute('id')
+
+        self.stream_management.enable(sm_id)
+        log.info("XMPP stream management enabled (resumable: %s)" % bool(sm_id))
+        self._deferred.callback(None)
+
+    def onFailed(self, element):
+        self.xmlstream.removeObserver('/enabled', self.onEnabled)
+        log.warn("XMPP stream management refused by the server")
+        self._deferred.callback(None)
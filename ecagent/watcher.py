@@ -0,0 +1,143 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+WATCH_POLL_INTERVAL = 10
+WATCH_SETTLE_TIME = 1
+WATCH_EXTENSIONS = ['.py', '.exe']
+
+# System imports
+import os
+
+# Twisted imports
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+import ecagent.twlogging as log
+
+try:
+    from twisted.internet import inotify
+    from twisted.python.filepath import FilePath
+
+except ImportError:
+    inotify = None
+
+
+class PluginWatcher:
+    def __init__(self, paths, callback, poll_interval=WATCH_POLL_INTERVAL):
+        """
+        Calls callback with the list of changed files (created, modified
+        or removed) in paths. Uses inotify when available and falls back
+        to mtime polling.
+
+        @param paths: Directories to watch.
+        @param callback: Called with a list of full file names.
+        @param poll_interval: Seconds between scans when polling.
+        """
+        self._paths = paths
+        self._callback = callback
+        self._poll_interval = poll_interval
+
+        self._changed = set()
+        self._settle = None
+        self._notifier = None
+        self._poller = None
+        self._snapshot = {}
+
+    def start(self):
+        if inotify:
+            try:
+                self._notifier = inotify.INotify()
+                self._notifier.startReading()
+
+                mask = inotify.IN_CLOSE_WRITE | inotify.IN_CREATE | inotify.IN_DELETE | \
+                       inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO
+
+                for path in self._paths:
+                    if os.path.isdir(path):
+                        self._notifier.watch(FilePath(path), mask=mask,
+                                             callbacks=[lambda ignored, fp, m, path=path: self._notify(path, fp)])
+
+                log.info("Watching plugins with inotify")
+                return
+
+            except Exception, e:
+                log.info("inotify not available (%s), polling plugins" % e)
+                self._notifier = None
+
+        self._snapshot = self._scan()
+        self._poller = LoopingCall(self._poll)
+        self._poller.start(self._poll_interval, now=False)
+
+    def stop(self):
+        if self._notifier:
+            self._notifier.loseConnection()
+            self._notifier = None
+
+        if self._poller and self._poller.running:
+            self._poller.stop()
+
+    def _notify(self, path, filepath):
+        self._queue(os.path.join(path, filepath.basename()))
+
+    def _poll(self):
+        snapshot = self._scan()
+
+        for filename in set(snapshot) ^ set(self._snapshot):
+            self._queue(filename)
+
+        for filename in set(snapshot) & set(self._snapshot):
+            if snapshot[filename] != self._snapshot[filename]:
+                self._queue(filename)
+
+        self._snapshot = snapshot
+
+    def _scan(self):
+        snapshot = {}
+        for path in self._paths:
+            try:
+                for filename in os.listdir(path):
+                    full_filename = os.path.join(path, filename)
+                    if self._interesting(full_filename):
+                        st = os.stat(full_filename)
+                        snapshot[full_filename] = (st.st_mtime, st.st_size)
+
+            except OSError:
+                pass
+
+        return snapshot
+
+    def _queue(self, filename):
+        if not self._interesting(filename):
+            return
+
+        # Wait for writes to settle and report all changes together
+        self._changed.add(filename)
+        if not self._settle or not self._settle.active():
+            self._settle = reactor.callLater(WATCH_SETTLE_TIME, self._report)
+
+    def _report(self):
+        changed, self._changed = sorted(self._changed), set()
+        log.info("Plugin files changed: %s" % ', '.join(os.path.basename(f) for f in changed))
+
+        try:
+            self._callback(changed)
+
+        except Exception, e:
+            log.error("Error reloading plugins: %s" % e)
+
+    @staticmethod
+    def _interesting(filename):
+        return os.path.splitext(filename)[1] in WATCH_EXTENSIONS
@@ -0,0 +1,319 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+_ZYGOTE_READY = '[__ready__]'
+_ZYGOTE_SCRIPT = '__zygote.py'
+_ZYGOTE_RESTART_DELAY = 5
+
+# System imports
+import os
+import simplejson as json
+from tempfile import mkdtemp
+
+# Twisted imports
+from twisted.internet import reactor
+from twisted.internet.protocol import ProcessProtocol, Protocol, ClientCreator
+from twisted.internet.error import ProcessTerminated, ProcessDone
+from twisted.python.failure import Failure
+
+import ecagent.twlogging as log
+from ecagent.rusage import RUSAGE_FIELDS, rusage_dict
+
+
+class Zygote(ProcessProtocol):
+    def __init__(self, python_runner, plugins_path, env, privileged=False):
+        """
+        Agent side of the plugin fork server (plugins/__zygote.py).
+
+        @param python_runner: Python interpreter used to start the zygote.
+        @param plugins_path: Directory holding the plugins and the zygote script.
+        @param env: Environment for the zygote (inherited by every command).
+        @param privileged: Start it with sudo (privileged helper).
+        """
+        self.ready = False
+        self.stopped = False
+        self.running = False
+
+        self._python_runner = python_runner
+        self._script = os.path.join(plugins_path, _ZYGOTE_SCRIPT)
+        self._socket_path = os.path.join(mkdtemp(prefix='ecagent-'), 'zygote.sock')
+        self._env = env
+        self._privileged = privileged
+
+        self._control = ''
+        self._last_token = 0
+        self._children = {}
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def start(self):
+        log.info("Starting plugin %s: %s" % (self._name(), self._script))
+        args = [self._python_runner, '-u', '-W ignore::DeprecationWarning', self._script, self._socket_path]
+
+        if self._privileged:
+            # Only the agent user may use it
+            args = ['sudo'] + args + [str(os.getuid())]
+
+        reactor.spawnProcess(self, args[0], args, env=self._env)
+
+    def _name(self):
+        return self._privileged and 'privileged helper' or 'zygote'
+
+    def stop(self):
+        self.stopped = True
+        self.ready = False
+
+        if self.running:
+            self.transport.closeStdin()
+
+    def drain(self):
+        """
+        No more commands for this zygote, it ends when the running ones are
+        done (and still accepts kill requests for them meanwhile).
+        """
+        self.stopped = True
+        self.ready = False
+
+        if self.running:
+            self.transport.write("drain\n")
+
+    def spawn(self, process_protocol, filename, command_name, limits=None, arguments=None, priority=None):
+        """
+        Runs a plugin command in a child forked from the zygote,
+        process_protocol gets the same calls as with reactor.spawnProcess()
+        """
+        self._last_token += 1
+        token = str(self._last_token)
+
+        child = ZygoteChild(self, token, process_protocol)
+        self._children[token] = child
+
+        header = {'token': token, 'stream': 'stdout', 'filename': filename, 'command': command_name,
+                  'arguments': arguments or [], 'limits': limits or {}, 'priority': priority or {}}
+        self._connect(child, 'stdout', header)
+        self._connect(child, 'stderr', {'token': token, 'stream': 'stderr'})
+
+        return child
+
+    def signal(self, pid, signal_name):
+        if self.running and pid:
+            self.transport.write("kill %d %s\n" % (pid, signal_name))
+
+    def _connect(self, child, stream, header):
+        d = ClientCreator(reactor, ZygoteStream, child, stream).connectUNIX(self._socket_path)
+        d.addCallback(lambda p: p.transport.write(json.dumps(header) + "\n"))
+        d.addErrback(child.failed)
+
+    def _remove(self, token):
+        self._children.pop(token, None)
+
+    def connectionMade(self):
+        self.running = True
+        log.debug("Plugin %s started (pid: %s)" % (self._name(), self.transport.pid))
+
+    def outReceived(self, data):
+        self._control += data
+        while "\n" in self._control:
+            line, self._control = self._control.split("\n", 1)
+            self._control_line(line.strip())
+
+    def errReceived(self, data):
+        log.error("Plugin %s: %s" % (self._name(), data))
+
+    def _control_line(self, line):
+        if line == _ZYGOTE_READY:
+            log.info("Plugin %s ready" % self._name())
+            self.ready = True
+            return
+
+        command = line.split()
+        if len(command) >= 4 and command[0] == 'exit':
+            child = self._children.get(command[1])
+            if child:
+                rusage = None
+                if len(command) >= 4 + len(RUSAGE_FIELDS):
+                    rusage = rusage_dict(command[4:4 + len(RUSAGE_FIELDS)])
+
+                # RSS of the zygote when forked (maxrss is never below it)
+                if len(command) == 5 + len(RUSAGE_FIELDS) and int(command[-1]) >= 0:
+                    child.maxrss_base = int(command[-1])
+
+                child.exited(int(command[3]), rusage)
+
+    def processEnded(self, status):
+        self.running = False
+        self.ready = False
+        self._control = ''
+
+        # Exit status of running children is lost with the zygote
+        for child in self._children.values():
+            child.exited(None)
+
+        if not self.stopped:
+            log.error("Plugin %s ended (%s), restarting" % (self._name(), status.value))
+            reactor.callLater(_ZYGOTE_RESTART_DELAY, self.start)
+            return
+
+        try:
+            os.rmdir(os.path.dirname(self._socket_path))
+        except OSError:
+            pass
+
+
+class ZygoteChild:
+    def __init__(self, zygote, token, process_protocol):
+        """
+        Process transport for a command forked from the zygote.
+        """
+        self.pid = None
+        self.status = -1
+        self.rusage = None
+        self.maxrss_base = None
+        self.streams = {}
+
+        self._zygote = zygote
+        self._token = token
+        self._proto = process_protocol
+        self._exited = False
+        self._ended = False
+        self._paused = False
+
+    def write(self, data):
+        if 'stdout' in self.streams:
+            self.streams['stdout'].transport.write(data)
+
+    def closeStdin(self):
+        if 'stdout' in self.streams:
+            self.streams['stdout'].transport.loseWriteConnection()
+
+    def pauseProducing(self):
+        self._paused = True
+        for stream in self.streams.values():
+            stream.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self._paused = False
+        for stream in self.streams.values():
+            stream.transport.resumeProducing()
+
+    def signalProcess(self, signal_name):
+        self._zygote.signal(self.pid, signal_name)
+
+    def loseConnection(self):
+        for stream in self.streams.values():
+            stream.transport.loseConnection()
+
+    def stream_started(self, stream, protocol):
+        self.streams[stream] = protocol
+        if self._paused:
+            # Connected while the output is paused
+            protocol.transport.pauseProducing()
+
+    def pid_received(self, pid):
+        self.pid = pid
+        self._proto.makeConnection(self)
+
+    def data_received(self, stream, data):
+        self._proto.childDataReceived(stream == 'stdout' and 1 or 2, data)
+
+    def stream_closed(self, stream):
+        self._maybe_ended()
+
+    def exited(self, status, rusage=None):
+        self._exited = True
+        self.status = status
+        self.rusage = rusage
+        self._zygote._remove(self._token)
+        self._maybe_ended()
+
+    def failed(self, failure):
+        log.error("Unable to connect to zygote: %s" % failure.getErrorMessage())
+        self.loseConnection()
+        self._exited = True
+        self._zygote._remove(self._token)
+        self._end()
+
+    def _maybe_ended(self):
+        if not self._exited:
+            return
+
+        for stream in self.streams.values():
+            if not stream.closed:
+                return
+
+        self._end()
+
+    def _end(self):
+        if self._ended:
+            return
+
+        self._ended = True
+
+        if self.pid is None:
+            # Never started: give the protocol a chance to set up
+            self._proto.makeConnection(self)
+
+        status = self.status
+        if status is None or status < 0:
+            reason = ProcessTerminated(exitCode=255)
+
+        elif os.WIFEXITED(status) and not os.WEXITSTATUS(status):
+            reason = ProcessDone(status)
+
+        elif os.WIFSIGNALED(status):
+            reason = ProcessTerminated(signal=os.WTERMSIG(status), status=status)
+
+        else:
+            reason = ProcessTerminated(exitCode=os.WEXITSTATUS(status), status=status)
+
+        self._proto.processEnded(Failure(reason))
+
+
+class ZygoteStream(Protocol):
+    def __init__(self, child, stream):
+        self.child = child
+        self.stream = stream
+        self.closed = False
+        self._pid_line = (stream == 'stdout')
+        self._buffer = ''
+
+    def connectionMade(self):
+        self.child.stream_started(self.stream, self)
+
+    def dataReceived(self, data):
+        if self._pid_line:
+            # First line of stdout is the child pid
+            self._buffer += data
+            if "\n" not in self._buffer:
+                return
+
+            pid, data = self._buffer.split("\n", 1)
+            self._pid_line = False
+            self._buffer = ''
+            self.child.pid_received(int(pid))
+
+            if not data:
+                return
+
+        self.child.data_received(self.stream, data)
+
+    def connectionLost(self, reason):
+        self.closed = True
+        self.child.stream_closed(self.stream)
+
+        if self._pid_line:
+            # Refused or not forked
+            self.child.failed(reason)
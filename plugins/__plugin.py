@@ -22,11 +22,26 @@ _E_COMMAND_NOT_DEFINED = 252
 
 _FINAL_OUTPUT_STRING = '[__response__]'
 
+# Protocols spoken besides the default one, chosen by the agent with
+# a second argument: plugin_xxx.py command frames
+_PROTOCOLS = ['frames']
+_PROTOCOL_FRAMES = 'frames'
+
+# Frames: type, payload length (big endian) and payload (see ecagent/frames.py)
+_FRAME_HEADER = '>cI'
+_FRAME_ARGS = 'A'
+_FRAME_OUTPUT = 'O'
+_FRAME_DATA = 'D'
+_FRAME_RESULT = 'R'
+
 PROTECTED_FILES = [
     '/etc/shadow',
 ]
 
+import os
 import sys
+import struct
+import threading
 sys.stdout.flush()
 sys.stderr.flush()
 
@@ -35,9 +50,42 @@ sys.stderr.flush()
 #logger = LoggerManager.getLogger(__name__)
 
 
+class _FrameWriter:
+    def __init__(self, stream):
+        """
+        Output stream for the frames protocol: everything written
+        (prints, ECMExec output threads...) goes as output frames.
+        """
+        self._stream = stream
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        if data:
+            self.frame(_FRAME_OUTPUT, data)
+
+    def writelines(self, lines):
+        self.write(''.join(lines))
+
+    def frame(self, frame_type, payload):
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+
+        self._lock.acquire()
+        try:
+            self._stream.write(struct.pack(_FRAME_HEADER, frame_type, len(payload)) + payload)
+            self._stream.flush()
+
+        finally:
+            self._lock.release()
+
+    def __getattr__(self, name):
+        # fileno(), flush()...
+        return getattr(self._stream, name)
+
+
 class ECMPlugin:
     def __init__(self, *argv, **kwargs):
-        pass
+        self._frames = None
 
     def run(self):
         """
@@ -48,7 +96,21 @@ class ECMPlugin:
 
         else:
             command_name = sys.argv[1]
-            sys.exit(self._run_command(command_name))
+            framed = len(sys.argv) > 2 and sys.argv[2] == _PROTOCOL_FRAMES
+            sys.exit(self._run_command(command_name, framed))
+
+    def partial(self, data):
+        """
+        Sends partial data (anything json can encode) to the agent
+        while the command is running.
+        """
+        import simplejson as json
+
+        if self._frames:
+            self._frames.frame(_FRAME_DATA, json.dumps(data))
+
+        else:
+            sys.stdout.write(json.dumps(data) + "\n")
 
     def cmd_plugin_version(self, *argv, **kwargs):
         """
@@ -101,7 +163,7 @@ class ECMPlugin:
                 command_args = inspect.getargspec(member[1])[0][1:]
                 print command_name, command_args
 
-    def _run_command(self, command_name):
+    def _run_command(self, command_name, framed=False):
         import simplejson as json
         from base64 import b64decode
 
@@ -112,29 +174,77 @@ class ECMPlugin:
             sys.stderr.write("Command not defined (%s)" % command_name)
             sys.exit(_E_COMMAND_NOT_DEFINED)
 
-        # Read command's arguments from stdin in json format (b64).
-        lines = []
-        for line in sys.stdin:
-            lines.append(line)
-        command_args = json.loads(b64decode('\n'.join(lines)))
+        if framed:
+            # Arguments come in one frame, output is framed from now on
+            self._frames = _FrameWriter(self._frames_stream())
+            sys.stdout = self._frames
+            command_args = json.loads(self._read_frame(sys.stdin, _FRAME_ARGS))
+
+        else:
+            # Read command's arguments from stdin in json format (b64).
+            lines = []
+            for line in sys.stdin:
+                lines.append(line)
+            command_args = json.loads(b64decode('\n'.join(lines)))
 
         try:
             # convert returned data to json
             data = command(**command_args)
-            sys.stdout.write("\n" + _FINAL_OUTPUT_STRING + "\n" + json.dumps(data))
+            self._write_result(json.dumps(data))
             return
 
         except Exception:
             exctype, value = sys.exc_info()[:2]
             data = {
                 'stdout': '',
-                'stderr': "ERROR: %s" % value,
+                # MemoryError and friends have no message
+                'stderr': "ERROR: %s" % (str(value) or exctype.__name__),
                 'out': _E_RUNNING_COMMAND,
                 'exception': 1
             }
-            sys.stdout.write("\n" + _FINAL_OUTPUT_STRING + "\n" + json.dumps(data))
+            self._write_result(json.dumps(data))
             return _E_RUNNING_COMMAND
 
+    def _write_result(self, result):
+        if self._frames:
+            self._frames.frame(_FRAME_RESULT, result)
+
+        else:
+            sys.stdout.write("\n" + _FINAL_OUTPUT_STRING + "\n" + result)
+
+    @staticmethod
+    def _frames_stream():
+        """
+        Private copy of stdout for the frames, the stdout file descriptor
+        goes to stderr: what writes to it (os.system, subprocesses, C
+        extensions) can't break the frames.
+        """
+        sys.stdout.flush()
+        fd = os.dup(1)
+        os.dup2(2, 1)
+
+        try:
+            # Not inherited by subprocesses
+            import fcntl
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+        except ImportError:
+            pass
+
+        return os.fdopen(fd, 'w', 0)
+
+    @staticmethod
+    def _read_frame(stream, frame_type):
+        header = stream.read(struct.calcsize(_FRAME_HEADER))
+        if len(header) != struct.calcsize(_FRAME_HEADER):
+            raise Exception("Missing %s frame" % frame_type)
+
+        read_type, length = struct.unpack(_FRAME_HEADER, header)
+        if read_type != frame_type:
+            raise Exception("Expected %s frame, got %r" % (frame_type, read_type))
+
+        return stream.read(length)
+
     def _update_plugins(self):
         pass
 
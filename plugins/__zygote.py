@@ -0,0 +1,457 @@
+# -*- coding:utf-8 -*-
+
+# Copyright (C) 2012 Juan Carlos Moreno <juancarlos.moreno at ecmanaged.com>
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Plugin fork server (zygote).
+
+Started once by the agent, it pre-imports the modules every plugin needs
+and forks a child per command instead of starting a new interpreter.
+
+Control channel (stdin/stdout with the agent):
+    agent -> zygote: kill <pid> <signal>
+                     drain (stop accepting commands and exit once running
+                     children are done, same on end of file)
+    zygote -> agent: [__ready__]
+                     exit <token> <pid> <wait status> <rusage...> <rss>
+                     (utime stime maxrss inblock oublock nvcsw nivcsw,
+                     rss: zygote anonymous KB when forked, -1 unknown)
+
+Every command opens two connections to the unix socket, each starting with
+a json header line: {"token": ..., "stream": "stdout", "filename": ...,
+"command": ..., "arguments": [...], "limits": {"cpu": [soft, hard], ...},
+"priority": {"nice": 10, "ionice": [class, level], "cpus": "2-3"}}
+and {"token": ..., "stream": "stderr"}. Once both are there the child is
+forked with stdin/stdout on the first one and stderr on the second. The child
+writes its pid as the first line and then behaves exactly like a
+"prlimit ... python -u plugin_xxx.py command arguments..." process.
+
+Started with sudo and the agent uid as second argument it is the privileged
+helper: root children for the plugins that need it, without a sudo per call.
+Only connections from the agent uid (SO_PEERCRED) and plugin_* files next to
+this script are accepted.
+"""
+
+_ZYGOTE_READY = '[__ready__]'
+_REAP_INTERVAL = 1
+_HEADER_MAX_LENGTH = 4096
+_PLUGIN_PREFIX = 'plugin_'
+_RUSAGE_FIELDS = ['utime', 'stime', 'maxrss', 'inblock', 'oublock', 'nvcsw', 'nivcsw']
+
+import os
+import runpy
+import sys
+import errno
+import select
+import resource
+import signal
+import socket
+import struct
+import warnings
+
+warnings.simplefilter('ignore', DeprecationWarning)
+
+# Pre-import everything plugins use, children get it for free
+import simplejson as json
+import __helper as ecm
+import __plugin
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+# Not in python 2 socket module (Linux value)
+_SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+
+
+class Zygote:
+    def __init__(self, socket_path, allow_uid=None):
+        self.socket_path = socket_path
+        self.plugins_path = os.path.dirname(os.path.abspath(__file__))
+
+        # Started by root for the agent user (privileged helper)
+        self.allow_uids = set([os.getuid()])
+        if allow_uid is not None:
+            self.allow_uids.add(allow_uid)
+        self.listener = None
+        self.control = ''
+        self.control_open = True
+
+        # Connections waiting for its header line
+        self.pending = {}
+
+        # token -> {'stdout': (conn, header), 'stderr': (conn, header)}
+        self.streams = {}
+
+        # pid -> (token, zygote RSS when forked)
+        self.children = {}
+
+    def run(self):
+        self._listen()
+
+        # SIGCHLD interrupts select() so children are reaped at once
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        self._control_write(_ZYGOTE_READY)
+
+        while self.listener or self.children:
+            rlist = self.pending.keys()
+            if self.listener:
+                rlist.append(self.listener)
+
+            if self.control_open:
+                rlist.append(sys.stdin)
+
+            try:
+                readable = select.select(rlist, [], [], _REAP_INTERVAL)[0]
+
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
+                readable = []
+
+            for item in readable:
+                if item is self.listener:
+                    self._accept()
+
+                elif item is sys.stdin:
+                    self._read_control()
+
+                elif item in self.pending:
+                    self._read_header(item)
+
+            self._reap()
+
+    def _drain(self):
+        """ Stop accepting commands, exits once running children are done """
+        if not self.listener:
+            return
+
+        self.listener.close()
+        self.listener = None
+
+        for conn in self.pending.keys():
+            conn.close()
+        self.pending = {}
+
+        for streams in self.streams.values():
+            for conn, header in streams.values():
+                conn.close()
+        self.streams = {}
+
+        try:
+            os.unlink(self.socket_path)
+        except OSError:
+            pass
+
+    def _listen(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        old_umask = os.umask(0077)
+        try:
+            self.listener.bind(self.socket_path)
+            for uid in self.allow_uids:
+                if uid != os.getuid():
+                    os.chown(self.socket_path, uid, -1)
+        finally:
+            os.umask(old_umask)
+
+        self.listener.listen(64)
+
+    def _accept(self):
+        try:
+            conn = self.listener.accept()[0]
+
+        except socket.error:
+            return
+
+        # Only the agent (socket permissions are not enough for a root helper)
+        try:
+            uid = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, _SO_PEERCRED, struct.calcsize('3i')))[1]
+
+        except socket.error:
+            uid = None
+
+        if uid not in self.allow_uids:
+            sys.stderr.write("Connection refused to uid %s\n" % uid)
+            conn.close()
+            return
+
+        self.pending[conn] = ''
+
+    def _read_control(self):
+        data = os.read(sys.stdin.fileno(), 4096)
+        if not data:
+            # Agent is gone
+            self.control_open = False
+            self._drain()
+            return
+
+        self.control += data
+        while "\n" in self.control:
+            line, self.control = self.control.split("\n", 1)
+            self._control_command(line.split())
+
+    def _control_command(self, command):
+        if command == ['drain']:
+            self._drain()
+
+        elif len(command) == 3 and command[0] == 'kill':
+            try:
+                signum = getattr(signal, 'SIG' + command[2])
+                os.killpg(int(command[1]), signum)
+
+            except (AttributeError, ValueError, OSError):
+                pass
+
+    def _read_header(self, conn):
+        # The agent waits for the child pid before sending anything else,
+        # so everything available now belongs to the header.
+        try:
+            data = conn.recv(_HEADER_MAX_LENGTH)
+        except socket.error:
+            data = ''
+
+        if not data:
+            del self.pending[conn]
+            conn.close()
+            return
+
+        self.pending[conn] += data
+        if "\n" not in self.pending[conn]:
+            if len(self.pending[conn]) > _HEADER_MAX_LENGTH:
+                del self.pending[conn]
+                conn.close()
+            return
+
+        try:
+            header = json.loads(self.pending.pop(conn).split("\n", 1)[0])
+            token = str(header['token'])
+            stream = header['stream']
+
+            if stream == 'stdout' and not self._is_plugin(header['filename']):
+                raise ValueError("Not a plugin: %s" % header['filename'])
+
+        except Exception, e:
+            sys.stderr.write("Invalid request: %s\n" % e)
+            conn.close()
+            return
+
+        self.streams.setdefault(token, {})[stream] = (conn, header)
+
+        if 'stdout' in self.streams[token] and 'stderr' in self.streams[token]:
+            streams = self.streams.pop(token)
+            rss = _forked_rss()
+            pid = self._fork(streams['stdout'], streams['stderr'])
+            if pid:
+                self.children[pid] = (token, rss)
+
+    def _is_plugin(self, filename):
+        filename = os.path.abspath(filename)
+        return os.path.dirname(filename) == self.plugins_path and \
+            os.path.basename(filename).startswith(_PLUGIN_PREFIX) and os.path.isfile(filename)
+
+    def _fork(self, stdout, stderr):
+        out_conn, header = stdout
+        err_conn = stderr[0]
+
+        try:
+            pid = os.fork()
+
+        except OSError:
+            out_conn.close()
+            err_conn.close()
+            return 0
+
+        if pid:
+            out_conn.close()
+            err_conn.close()
+            return pid
+
+        # Child
+        code = 255
+        try:
+            self._close_others(out_conn, err_conn)
+            os.setsid()
+            self._set_priority(header.get('priority') or {})
+            self._set_limits(header.get('limits') or {})
+
+            os.dup2(out_conn.fileno(), 0)
+            os.dup2(out_conn.fileno(), 1)
+            os.dup2(err_conn.fileno(), 2)
+            out_conn.close()
+            err_conn.close()
+
+            os.write(1, "%d\n" % os.getpid())
+
+            # Same as python -u (__stdout__... keep them open if replaced)
+            sys.stdin = sys.__stdin__ = os.fdopen(0, 'r')
+            sys.stdout = sys.__stdout__ = os.fdopen(1, 'w', 0)
+            sys.stderr = sys.__stderr__ = os.fdopen(2, 'w', 0)
+
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+            code = self._run_plugin(header['filename'], header.get('command', ''), header.get('arguments') or [])
+
+        except SystemExit, e:
+            code = self._exit_code(e)
+
+        except:
+            import traceback
+            traceback.print_exc()
+
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except:
+            pass
+
+        os._exit(code)
+
+    def _close_others(self, *keep):
+        if self.listener:
+            self.listener.close()
+
+        for conn in self.pending.keys():
+            conn.close()
+
+        for streams in self.streams.values():
+            for conn, header in streams.values():
+                if conn not in keep:
+                    conn.close()
+
+    @staticmethod
+    def _set_limits(limits):
+        for name, (soft, hard) in limits.items():
+            resource.setrlimit(getattr(resource, 'RLIMIT_' + name.upper()), (soft, hard))
+
+    @staticmethod
+    def _set_priority(priority):
+        if priority.get('nice'):
+            os.nice(priority['nice'])
+
+        if not priority.get('ionice') and not priority.get('cpus'):
+            return
+
+        # Errors go to the zygote stderr
+        if not psutil:
+            sys.stderr.write("psutil not available, ionice and cpus ignored\n")
+            return
+
+        process = psutil.Process(os.getpid())
+        try:
+            if priority.get('ionice'):
+                io_class, level = priority['ionice']
+                _psutil_set(process, 'ionice', io_class, level)
+
+            if priority.get('cpus'):
+                _psutil_set(process, 'cpu_affinity', _cpu_list(priority['cpus']))
+
+        except Exception, e:
+            sys.stderr.write("Unable to set process priority %s: %s\n" % (priority, e))
+
+    def _run_plugin(self, filename, command_name, arguments):
+
+        sys.argv = [filename, command_name] + arguments
+        sys.path[0] = os.path.dirname(os.path.abspath(filename))
+
+        try:
+            runpy.run_path(filename, run_name='__main__')
+
+        except SystemExit, e:
+            return self._exit_code(e)
+
+        return 0
+
+    @staticmethod
+    def _exit_code(e):
+        if e.code is None:
+            return 0
+
+        if isinstance(e.code, int):
+            return e.code
+
+        sys.stderr.write(str(e.code))
+        return 1
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+
+            except OSError:
+                return
+
+            if not pid:
+                return
+
+            child = self.children.pop(pid, None)
+            if child:
+                token, rss = child
+                usage = ' '.join(repr(getattr(rusage, 'ru_' + field)) for field in _RUSAGE_FIELDS)
+                self._control_write("exit %s %d %d %s %d" % (token, pid, status, usage, rss))
+
+    @staticmethod
+    def _control_write(line):
+        sys.stdout.write(line + "\n")
+        sys.stdout.flush()
+
+
+def _forked_rss():
+    """ Anonymous RSS (KB) a child forked now starts with, -1 if unknown """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            resident, shared = f.read().split()[1:3]
+            return (int(resident) - int(shared)) * resource.getpagesize() / 1024
+
+        finally:
+            f.close()
+
+    except (IOError, ValueError):
+        return -1
+
+
+def _psutil_set(process, name, *args):
+    # psutil < 2.0: set_ionice, set_cpu_affinity
+    method = getattr(process, name, None) or getattr(process, 'set_' + name)
+    method(*args)
+
+
+def _cpu_list(cpus):
+    """ "0,2-3" -> [0, 2, 3] """
+    cpu_list = []
+    for cpu_range in cpus.split(','):
+        if '-' in cpu_range:
+            first, last = cpu_range.split('-', 1)
+            cpu_list.extend(range(int(first), int(last) + 1))
+
+        elif cpu_range:
+            cpu_list.append(int(cpu_range))
+
+    return cpu_list
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.stderr.write("Usage: %s <socket path> [<agent uid>]\n" % sys.argv[0])
+        sys.exit(1)
+
+    Zygote(sys.argv[1], len(sys.argv) == 3 and int(sys.argv[2]) or None).run()
@@ -16,6 +16,11 @@
 
 RUN_AS_ROOT = False
 
+# Seconds the agent may reuse a result (0: read only, never cached)
+CACHE_TTL = {
+    'monitor_get': 0
+}
+
 import os
 import sys
 
@@ -14,6 +14,13 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+# Seconds the agent may reuse a result (0: read only, never cached)
+CACHE_TTL = {
+    'pip_check_version': 300,
+    'pip_installed_packages': 60,
+    'pip_outdated_packages': 300
+}
+
 go = True
 
 try:
@@ -16,6 +16,16 @@
 
 RUN_AS_ROOT = True
 
+# Seconds the agent may reuse a result (0: read only, never cached)
+CACHE_TTL = {
+    'proc_mem_name': 5,
+    'proc_mem_regex': 5,
+    'proc_num_name': 5,
+    'proc_num_regex': 5,
+    'proc_list_regex': 5,
+    'command_exists': 60
+}
+
 import os
 import re
 import psutil
@@ -16,6 +16,12 @@
 
 RUN_AS_ROOT = True
 
+# Seconds the agent may reuse a result (0: read only, never cached)
+CACHE_TTL = {
+    'service_state': 10,
+    'service_exists': 60
+}
+
 from commands import getstatusoutput
 import time
 
@@ -16,6 +16,12 @@
 
 RUN_AS_ROOT = False
 
+# Seconds the agent may reuse a result (0: read only, never cached)
+CACHE_TTL = {
+    'agent_ping': 0,
+    'system_info': 60
+}
+
 _DEFAULT_CPU_INTERVAL = 0.5
 
 # Local
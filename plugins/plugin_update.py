@@ -16,6 +16,12 @@
 
 RUN_AS_ROOT = True
 
+# Seconds the agent may reuse a result (0: read only, never cached)
+CACHE_TTL = {
+    'update_check': 300,
+    'reboot_require': 60
+}
+
 import os
 import sys
 from time import time